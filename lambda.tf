@@ -10,6 +10,48 @@ resource "aws_sns_topic_subscription" "lifecycle" {
   endpoint  = module.lambda.lambda_function_arn
 }
 
+locals {
+  # Spot drains are reconciled with the terminating lifecycle hook through the deduplication table,
+  # as the interruption warning and the hook are processed by different invocations
+  deduplication_enabled = var.enable_deduplication || var.enable_spot_drain
+
+  # Tells the Lambda where to re-publish a lifecycle hook it continues later
+  continuation_environment_variables = { for key, value in {
+    CONTINUATION_ENABLED  = "true"
+    LIFECYCLE_TOPIC_ARN   = aws_sns_topic.lifecycle.arn
+    CONTINUATION_ROLE_ARN = one(aws_iam_role.continuation[*].arn)
+  } : key => value if var.enable_continuation }
+
+  deduplication_environment_variables = { for key, value in {
+    DEDUP_TABLE = one(aws_dynamodb_table.deduplication[*].name)
+  } : key => value if local.deduplication_enabled }
+
+  spot_drain_environment_variables = { for key, value in {
+    AUTOSCALING_GROUP_NAME = var.autoscaling_group_name
+  } : key => value if var.enable_spot_drain }
+}
+
+# Records the lifecycle messages the Lambda processed until DynamoDB expires them
+resource "aws_dynamodb_table" "deduplication" {
+  count = local.deduplication_enabled ? 1 : 0
+
+  name         = "${var.name}-lifecycle"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "Key"
+
+  attribute {
+    name = "Key"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "ExpiresAt"
+    enabled        = true
+  }
+
+  tags = var.extra_tags
+}
+
 module "lambda" {
   source = "git::https://github.com/terraform-aws-modules/terraform-aws-lambda.git?ref=v8.0.1"
 
@@ -25,7 +67,7 @@ module "lambda" {
   # If publish is disabled, there will be "Error adding new Lambda Permission for notify_slack: InvalidParameterValueException: We currently do not support adding policies for $LATEST."
   publish = true
 
-  environment_variables = var.lambda_environment_variables
+  environment_variables = merge(var.lambda_environment_variables, local.continuation_environment_variables, local.deduplication_environment_variables, local.spot_drain_environment_variables)
 
   create_role               = var.lambda_role == ""
   lambda_role               = var.lambda_role
@@ -51,6 +93,36 @@ module "lambda" {
   tags = var.extra_tags
 }
 
+# Spot interruption warnings and rebalance recommendations invoke the Lambda directly
+resource "aws_cloudwatch_event_rule" "spot_drain" {
+  count = var.enable_spot_drain ? 1 : 0
+
+  name        = "${var.name}-spot-drain"
+  description = "Drains the Kubernetes nodes of spot instances which are about to be interrupted"
+  event_pattern = jsonencode({
+    source      = ["aws.ec2"]
+    detail-type = ["EC2 Spot Instance Interruption Warning", "EC2 Instance Rebalance Recommendation"]
+  })
+  tags = var.extra_tags
+}
+
+resource "aws_cloudwatch_event_target" "spot_drain" {
+  count = var.enable_spot_drain ? 1 : 0
+
+  rule = aws_cloudwatch_event_rule.spot_drain[0].name
+  arn  = module.lambda.lambda_function_arn
+}
+
+resource "aws_lambda_permission" "spot_drain" {
+  count = var.enable_spot_drain ? 1 : 0
+
+  statement_id  = "AllowExecutionFromEventBridge"
+  action        = "lambda:InvokeFunction"
+  function_name = module.lambda.lambda_function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.spot_drain[0].arn
+}
+
 data "aws_region" "current" {}
 
 resource "null_resource" "assign_default_sg" {
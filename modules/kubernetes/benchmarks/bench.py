@@ -0,0 +1,278 @@
+"""Offline benchmark of the lifecycle hook's hot paths.
+
+Runs lambda_handler for launching, terminating, spot interruption or single-master events against a fake Kubernetes
+API server (in a child process, so it doesn't count towards the hook's memory) and in-process
+stand-ins for the AWS clients, then reports wall-clock time, API calls by verb and peak memory.
+The spot scenario sends an EC2 Spot Instance Interruption Warning followed by the terminating
+lifecycle hook of the same instances. With --continuation the hook schedules the rest of long drains and launches, and the benchmark
+replays every scheduled continuation after --replay-delay seconds until none is left.
+
+    AWS_REGION=us-east-1 python bench.py terminate --pods 110 --latency 0.02
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+
+FUNCTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions')
+ASG_NAME = 'bench-asg'
+LIFECYCLE_HOOK_NAME = 'bench-hook'
+LAUNCHING = 'autoscaling:EC2_INSTANCE_LAUNCHING'
+TERMINATING = 'autoscaling:EC2_INSTANCE_TERMINATING'
+
+
+def node_name(index):
+    return 'ip-10-0-%d-%d.ec2.internal' % (index // 250, index % 250)
+
+
+def instance_id(index):
+    return 'i-%017x' % index
+
+
+def build_cluster(options):
+    from fake_k8s import FakeCluster
+
+    cluster = FakeCluster(latency=options.latency, rate_429=options.rate_429,
+                          termination_delay=options.termination_delay,
+                          replacement_delay=options.replacement_delay, seed=options.seed)
+
+    for index in range(options.nodes if options.scenario != 'master' else 2):
+        if options.scenario == 'launch':
+            cluster.add_node(node_name(index), register_after=options.register_after, ready_after=options.ready_after)
+        else:
+            cluster.add_node(node_name(index))
+
+    if options.scenario in ('terminate', 'spot'):
+        pdb_pods = int(options.pods * options.pdb_fraction)
+        deployments = max(1, options.pods // options.replicas)
+        for deployment in range(deployments):
+            if deployment * options.replicas < pdb_pods:
+                cluster.add_pdb('bench', 'app-%d' % deployment, {'app': 'app-%d' % deployment}, options.pdb_allowed)
+        for index in range(options.nodes):
+            for pod in range(options.pods):
+                deployment = pod // options.replicas
+                cluster.add_pod('bench', 'app-%d-%s-%d' % (deployment, index, pod), node_name(index),
+                                labels={'app': 'app-%d' % deployment}, priority=(deployment % 3) * 1000,
+                                termination_grace_period=options.termination_grace_period)
+            for pod in range(options.stateful_pods):
+                cluster.add_pod('bench', 'db-%d-%d' % (index, pod), node_name(index), labels={'app': 'db'},
+                                owner_kind='StatefulSet', priority=2000)
+            for pod in range(options.job_pods):
+                cluster.add_pod('bench', 'batch-%d-%d' % (index, pod), node_name(index), labels={'app': 'batch'},
+                                owner_kind='Job', termination_delay=options.job_termination_delay,
+                                termination_grace_period=options.job_termination_grace_period)
+            # DaemonSet and mirror pods are listed but never evicted
+            cluster.add_pod('kube-system', 'kube-proxy-%d' % index, node_name(index), owner_kind='DaemonSet')
+    return cluster
+
+
+def serve(options, queue):
+    """Runs the fake Kubernetes API server in a child process and reports its URL."""
+    from fake_k8s import FakeKubernetesServer
+
+    with FakeKubernetesServer(build_cluster(options)) as server:
+        queue.put((server.url, server.kubeconfig()))
+        while True:
+            time.sleep(3600)
+
+
+def build_account(options):
+    from fake_aws import FakeAccount
+
+    account = FakeAccount(ASG_NAME, latency=options.aws_latency)
+    if options.scenario == 'master':
+        if options.target_group:
+            account.target_group_arn = 'arn:aws:elasticloadbalancing:us-east-1:000000000000:targetgroup/bench-master/0'
+        else:
+            account.load_balancer_name = 'bench-master'
+        account.add_instance(instance_id(0), node_name(0), lifecycle_state='Terminating:Wait')
+        account.add_instance(instance_id(1), node_name(1), in_service_after=options.ready_after)
+    else:
+        for index in range(options.nodes):
+            state = 'Pending:Wait' if options.scenario == 'launch' else 'Terminating:Wait'
+            account.add_instance(instance_id(index), node_name(index), lifecycle_state=state, spot=options.scenario == 'spot')
+        account.desired_capacity = max(account.desired_capacity, 2)
+    return account
+
+
+def build_spot_events(options):
+    return [{
+        'version': '0',
+        'source': 'aws.ec2',
+        'detail-type': 'EC2 Spot Instance Interruption Warning',
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'detail': {'instance-id': instance_id(index), 'instance-action': 'terminate'}
+    } for index in range(options.nodes)]
+
+
+def build_event(options):
+    transition = LAUNCHING if options.scenario == 'launch' else TERMINATING
+    records = options.nodes if options.scenario != 'master' else 1
+    return {'Records': [{
+        'EventSource': 'aws:sns',
+        'Sns': {'Message': json.dumps({
+            'LifecycleHookName': LIFECYCLE_HOOK_NAME,
+            'AutoScalingGroupName': ASG_NAME,
+            'LifecycleTransition': transition,
+            'EC2InstanceId': instance_id(index),
+            'Destination': 'AutoScalingGroup',
+            'LifecycleActionToken': 'token-%d' % index
+        })}
+    } for index in range(records)]}
+
+
+def run(options):
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(options, queue), daemon=True)
+    server.start()
+    url, kubeconfig = queue.get(timeout=30)
+
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    os.environ.update({
+        'CLUSTER_NAME': 'bench',
+        'KUBE_CONFIG_BUCKET': 'bench',
+        'KUBE_CONFIG_OBJECT': 'kubeconfig',
+        'KUBERNETES_NODE_ROLE': 'master' if options.scenario == 'master' else 'worker',
+        'LAUNCHING_TIMEOUT': str(options.timeout),
+        'TERMINATING_TIMEOUT': str(options.timeout),
+        'EVICTION_CONCURRENCY': str(options.concurrency),
+        'CONTINUATION_ENABLED': 'true' if options.continuation else 'false',
+        'CONTINUATION_INTERVAL': str(options.continuation_interval),
+        'LIFECYCLE_TOPIC_ARN': 'arn:aws:sns:us-east-1:000000000000:bench',
+        'CONTINUATION_ROLE_ARN': 'arn:aws:iam::000000000000:role/bench-continuation',
+        'DRAIN_ORDER': options.drain_order,
+        'JOB_GRACE_PERIOD': '' if options.job_grace_period is None else str(options.job_grace_period),
+        'DRAIN_WAIT_FOR_JOBS': 'false' if options.no_wait_for_jobs else 'true'
+    })
+    sys.path.insert(0, FUNCTIONS_PATH)
+
+    import cache
+    import handler
+    from fake_aws import FakeAutoScaling, FakeEC2, FakeELB, FakeELBv2, FakeS3, FakeScheduler
+
+    account = build_account(options)
+    handler.KUBE_FILEPATH = os.path.join(tempfile.mkdtemp(), 'kubeconfig')
+    handler.aws_clients.update({
+        'autoscaling': FakeAutoScaling(account),
+        'ec2': FakeEC2(account),
+        'elb': FakeELB(account),
+        'elbv2': FakeELBv2(account),
+        's3': FakeS3(account, kubeconfig),
+        'scheduler': FakeScheduler(account)
+    })
+    cache.clear()
+
+    tracemalloc.start()
+    started = time.time()
+    # SNS delivers at least once, so the same event may arrive again after it was processed
+    events = [build_event(options)] * (1 + options.duplicates)
+    if options.scenario == 'spot':
+        # the interruption warnings arrive before the auto scaling group terminates the instances
+        events = build_spot_events(options) + events
+    invocations = 0
+    busy = 0.0
+    while events:
+        event = events.pop(0)
+        invoked = time.time()
+        try:
+            result = handler.lambda_handler(event, None)
+        except Exception as e:
+            result = {'error': str(e)}
+        busy += time.time() - invoked
+        invocations += 1
+
+        # deliver the continuations scheduled by this invocation as the next event
+        with account.lock:
+            schedules, account.schedules = account.schedules, []
+        if schedules:
+            time.sleep(options.replay_delay)
+            events.insert(0, {'Records': [{'EventSource': 'aws:sns', 'Sns': {'Message': schedule['Input']}}
+                                          for schedule in schedules]})
+    elapsed = time.time() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    with urllib.request.urlopen(url + '/_stats') as response:
+        stats = json.loads(response.read())
+    server.terminate()
+
+    return {
+        'scenario': options.scenario,
+        'wall_clock_seconds': round(elapsed, 3),
+        'invocations': invocations,
+        'busy_seconds': round(busy, 3),
+        'peak_memory_bytes': peak,
+        'kubernetes_calls': stats['calls'],
+        'kubernetes_bytes_received': stats['bytes_sent'],
+        'aws_calls': dict(account.calls),
+        'remaining_pods': stats['pods'],
+        'lifecycle_results': dict((i, r[0]) for i, r in account.lifecycle_results.items()),
+        'result': result
+    }
+
+
+def report(results):
+    print('scenario            %s' % results['scenario'])
+    print('wall clock          %.3fs' % results['wall_clock_seconds'])
+    print('invocations         %d (%.3fs busy)' % (results['invocations'], results['busy_seconds']))
+    print('peak memory         %.1f KiB' % (results['peak_memory_bytes'] / 1024.0))
+    print('bytes received      %d' % results['kubernetes_bytes_received'])
+    print('remaining pods      %d' % results['remaining_pods'])
+    print('lifecycle results   %s' % ', '.join('%s=%s' % item for item in sorted(results['lifecycle_results'].items())))
+    print('kubernetes calls')
+    for call, count in sorted(results['kubernetes_calls'].items()):
+        print('  %-30s %d' % (call, count))
+    print('aws calls')
+    for call, count in sorted(results['aws_calls'].items()):
+        print('  %-30s %d' % (call, count))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenario', choices=['launch', 'terminate', 'spot', 'master'])
+    parser.add_argument('--nodes', type=int, default=1, help='lifecycle records in the event')
+    parser.add_argument('--pods', type=int, default=110, help='evictable pods per terminating node')
+    parser.add_argument('--replicas', type=int, default=5, help='pods per deployment (and per PDB)')
+    parser.add_argument('--stateful-pods', type=int, default=0, help='StatefulSet pods per terminating node')
+    parser.add_argument('--job-pods', type=int, default=0, help='Job pods per terminating node')
+    parser.add_argument('--job-termination-delay', type=float, default=None, help='seconds an evicted Job pod takes to go away')
+    parser.add_argument('--job-termination-grace-period', type=int, default=30,
+                        help='terminationGracePeriodSeconds of the Job pods, which caps their termination delay')
+    parser.add_argument('--pdb-fraction', type=float, default=0.0, help='fraction of pods covered by PDBs')
+    parser.add_argument('--pdb-allowed', type=int, default=1, help='initial disruptionsAllowed of every PDB')
+    parser.add_argument('--latency', type=float, default=0.0, help='Kubernetes API latency in seconds')
+    parser.add_argument('--aws-latency', type=float, default=0.0, help='AWS API latency in seconds')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='probability an eviction is rejected')
+    parser.add_argument('--termination-delay', type=float, default=0.0, help='seconds an evicted pod takes to go away')
+    parser.add_argument('--termination-grace-period', type=int, default=30,
+                        help='terminationGracePeriodSeconds of the Deployment pods, which caps their termination delay')
+    parser.add_argument('--replacement-delay', type=float, default=0.5, help='seconds until a PDB allows another disruption')
+    parser.add_argument('--register-after', type=float, default=0.0, help='seconds until a launching node registers')
+    parser.add_argument('--ready-after', type=float, default=1.0, help='seconds until a launching node is Ready')
+    parser.add_argument('--target-group', action='store_true', help='put the master behind an NLB target group')
+    parser.add_argument('--concurrency', type=int, default=10, help='EVICTION_CONCURRENCY')
+    parser.add_argument('--timeout', type=float, default=550, help='LAUNCHING_TIMEOUT and TERMINATING_TIMEOUT')
+    parser.add_argument('--drain-order', default='default', choices=['default', 'workload'], help='DRAIN_ORDER')
+    parser.add_argument('--job-grace-period', type=int, default=None, help='JOB_GRACE_PERIOD')
+    parser.add_argument('--no-wait-for-jobs', action='store_true', help='complete the drain without waiting for Job pods')
+    parser.add_argument('--continuation', action='store_true', help='schedule long drains and launches instead of waiting')
+    parser.add_argument('--continuation-interval', type=int, default=60, help='CONTINUATION_INTERVAL')
+    parser.add_argument('--replay-delay', type=float, default=0.5, help='seconds until a scheduled continuation is replayed')
+    parser.add_argument('--duplicates', type=int, default=0, help='deliveries of the event after the first one')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    results = run(options)
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
@@ -0,0 +1,143 @@
+"""Local stand-ins for the autoscaling, EC2, ELB, ELBv2, S3 and scheduler clients used by the lifecycle hook.
+
+Each stand-in implements only the operations the hook calls, answers from an in-memory
+FakeAccount and counts every call by service and operation.
+"""
+import collections
+import threading
+import time
+
+
+class FakeAccount(object):
+    """Holds the instances, the auto scaling group and its load balancer."""
+
+    def __init__(self, asg_name, latency=0.0):
+        self.asg_name = asg_name
+        self.latency = latency
+        self.instances = {}
+        self.desired_capacity = 0
+        self.load_balancer_name = None
+        self.target_group_arn = None
+        self.in_service_after = {}
+        self.lifecycle_results = {}
+        self.schedules = []
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def add_instance(self, instance_id, node_name, lifecycle_state='InService', spot=False, in_service_after=0.0):
+        instance = {'InstanceId': instance_id, 'PrivateDnsName': node_name, 'LifecycleState': lifecycle_state,
+                    'Tags': [{'Key': 'aws:autoscaling:groupName', 'Value': self.asg_name}]}
+        if spot:
+            instance['InstanceLifecycle'] = 'spot'
+        self.instances[instance_id] = instance
+        self.in_service_after[instance_id] = time.time() + in_service_after
+        self.desired_capacity = len([i for i in self.instances.values() if 'Terminating' not in i['LifecycleState']])
+
+    def call(self, service, operation):
+        with self.lock:
+            self.calls[service + ':' + operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeAutoScaling(object):
+
+    def __init__(self, account):
+        self.account = account
+
+    def describe_auto_scaling_groups(self, AutoScalingGroupNames):
+        self.account.call('autoscaling', 'DescribeAutoScalingGroups')
+        return {'AutoScalingGroups': [{
+            'AutoScalingGroupName': self.account.asg_name,
+            'DesiredCapacity': self.account.desired_capacity,
+            'LoadBalancerNames': [self.account.load_balancer_name] if self.account.load_balancer_name else [],
+            'TargetGroupARNs': [self.account.target_group_arn] if self.account.target_group_arn else [],
+            'Instances': [{'InstanceId': i['InstanceId'], 'LifecycleState': i['LifecycleState']}
+                          for i in self.account.instances.values()]
+        }]}
+
+    def describe_load_balancers(self, AutoScalingGroupName):
+        self.account.call('autoscaling', 'DescribeLoadBalancers')
+        return {'LoadBalancers': [{'LoadBalancerName': self.account.load_balancer_name, 'State': 'InService'}]}
+
+    def complete_lifecycle_action(self, LifecycleHookName, AutoScalingGroupName, LifecycleActionResult, InstanceId,
+                                  **kwargs):
+        self.account.call('autoscaling', 'CompleteLifecycleAction')
+        with self.account.lock:
+            self.account.lifecycle_results[InstanceId] = (LifecycleActionResult, time.time())
+
+    def record_lifecycle_action_heartbeat(self, LifecycleHookName, AutoScalingGroupName, InstanceId, **kwargs):
+        self.account.call('autoscaling', 'RecordLifecycleActionHeartbeat')
+
+
+class FakeEC2(object):
+
+    def __init__(self, account):
+        self.account = account
+
+    def describe_instances(self, InstanceIds):
+        self.account.call('ec2', 'DescribeInstances')
+        return {'Reservations': [{'Instances': [dict(self.account.instances[i]) for i in InstanceIds]}]}
+
+
+class FakeELB(object):
+
+    def __init__(self, account):
+        self.account = account
+
+    def _state(self, instance_id):
+        return 'InService' if time.time() >= self.account.in_service_after[instance_id] else 'OutOfService'
+
+    def describe_load_balancers(self, LoadBalancerNames):
+        self.account.call('elb', 'DescribeLoadBalancers')
+        return {'LoadBalancerDescriptions': [{
+            'LoadBalancerName': self.account.load_balancer_name,
+            'Instances': [{'InstanceId': i} for i in self.account.instances]
+        }]}
+
+    def describe_instance_health(self, LoadBalancerName, Instances=None):
+        self.account.call('elb', 'DescribeInstanceHealth')
+        instance_ids = [i['InstanceId'] for i in Instances] if Instances else list(self.account.instances)
+        return {'InstanceStates': [{'InstanceId': i, 'State': self._state(i)} for i in instance_ids]}
+
+
+class FakeELBv2(object):
+
+    def __init__(self, account):
+        self.account = account
+
+    def describe_target_health(self, TargetGroupArn):
+        self.account.call('elbv2', 'DescribeTargetHealth')
+        now = time.time()
+        return {'TargetHealthDescriptions': [{
+            'Target': {'Id': i, 'Port': 6443},
+            'TargetHealth': {'State': 'healthy' if now >= self.account.in_service_after[i] else 'initial'}
+        } for i in self.account.instances]}
+
+
+class FakeS3(object):
+
+    def __init__(self, account, content=''):
+        self.account = account
+        self.content = content
+
+    def head_object(self, Bucket, Key):
+        self.account.call('s3', 'HeadObject')
+        return {'ETag': '"%x"' % (hash(self.content) & 0xffffffff)}
+
+    def download_file(self, Bucket, Key, Filename):
+        self.account.call('s3', 'GetObject')
+        with open(Filename, 'w') as f:
+            f.write(self.content)
+
+
+class FakeScheduler(object):
+    """Keeps the one-time schedules so that the benchmark can replay them without waiting."""
+
+    def __init__(self, account):
+        self.account = account
+
+    def create_schedule(self, Name, ScheduleExpression, Target, **kwargs):
+        self.account.call('scheduler', 'CreateSchedule')
+        with self.account.lock:
+            self.account.schedules.append({'Name': Name, 'ScheduleExpression': ScheduleExpression, 'Input': Target['Input']})
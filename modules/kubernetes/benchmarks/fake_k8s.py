@@ -0,0 +1,428 @@
+"""A local, in-memory stand-in for the parts of the Kubernetes API the lifecycle hook uses.
+
+It serves pod, node and PodDisruptionBudget lists (with limit/continue pagination and field
+selectors), watches resumed from a resourceVersion, node reads, node patches (with resourceVersion
+preconditions), evictions and pod deletions.
+Latency and 429 rates are configurable, and every request is counted by verb and resource.
+"""
+import collections
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+NODES_PATH = re.compile(r'^/api/v1/nodes(?:/(?P<name>[^/]+))?$')
+PODS_PATH = re.compile(r'^/api/v1/pods$')
+NAMESPACED_POD_PATH = re.compile(r'^/api/v1/namespaces/(?P<namespace>[^/]+)/pods/(?P<name>[^/]+)(?P<eviction>/eviction)?$')
+PDBS_PATH = re.compile(r'^/apis/policy/v1/poddisruptionbudgets$')
+STATS_PATH = '/_stats'
+
+
+class FakeCluster(object):
+    """Holds the cluster state and the event log the watches are served from."""
+
+    def __init__(self, latency=0.0, rate_429=0.0, termination_delay=0.0, replacement_delay=0.0, seed=0):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.termination_delay = termination_delay
+        self.replacement_delay = replacement_delay
+        self.random = random.Random(seed)
+        self.nodes = {}
+        self.pods = {}
+        self.pdbs = {}
+        self.termination_delays = {}
+        self.resource_version = 1
+        self.events = []
+        self.calls = collections.Counter()
+        self.bytes_sent = 0
+        self.lock = threading.Condition()
+
+    # state changes
+
+    def _emit(self, kind, event_type, obj):
+        # must be called with the lock held
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        self.events.append((self.resource_version, kind, event_type, json.loads(json.dumps(obj))))
+        self.lock.notify_all()
+
+    def add_node(self, name, register_after=0.0, ready_after=0.0):
+        """Registers the node after register_after seconds and marks it Ready after ready_after seconds."""
+        def register():
+            with self.lock:
+                node = {
+                    'apiVersion': 'v1',
+                    'kind': 'Node',
+                    'metadata': {'name': name, 'labels': {}},
+                    'spec': {},
+                    'status': {'conditions': [{'type': 'Ready', 'status': 'False'}]}
+                }
+                self.nodes[name] = node
+                self._emit('nodes', 'ADDED', node)
+
+        def ready():
+            with self.lock:
+                node = self.nodes.get(name)
+                if node is not None:
+                    node['status']['conditions'] = [{'type': 'Ready', 'status': 'True'}]
+                    self._emit('nodes', 'MODIFIED', node)
+
+        self._at(register_after, register)
+        self._at(max(register_after, ready_after), ready)
+
+    def add_pod(self, namespace, name, node_name, labels=None, owner_kind='ReplicaSet', priority=0,
+                priority_class_name=None, termination_delay=None, termination_grace_period=30):
+        with self.lock:
+            if termination_delay is not None:
+                # e.g. a batch job which takes its time to checkpoint
+                self.termination_delays[(namespace, name)] = termination_delay
+            pod = {
+                'apiVersion': 'v1',
+                'kind': 'Pod',
+                'metadata': {
+                    'namespace': namespace,
+                    'name': name,
+                    'labels': labels or {},
+                    'annotations': {'example.com/padding': 'x' * 2048},
+                    'ownerReferences': [{'apiVersion': 'apps/v1', 'kind': owner_kind, 'name': name.rsplit('-', 1)[0],
+                                         'uid': name, 'controller': True}]
+                },
+                'spec': {
+                    'nodeName': node_name,
+                    'priority': priority,
+                    'priorityClassName': priority_class_name,
+                    'terminationGracePeriodSeconds': termination_grace_period,
+                    'containers': [{'name': 'app', 'image': 'example.com/app:latest',
+                                    'env': [{'name': 'VAR_%d' % i, 'value': 'value-%d' % i} for i in range(20)]}]
+                },
+                'status': {'phase': 'Running'}
+            }
+            self.pods[(namespace, name)] = pod
+            self._emit('pods', 'ADDED', pod)
+
+    def add_pdb(self, namespace, name, match_labels, disruptions_allowed):
+        with self.lock:
+            pdb = {
+                'apiVersion': 'policy/v1',
+                'kind': 'PodDisruptionBudget',
+                'metadata': {'namespace': namespace, 'name': name},
+                'spec': {'selector': {'matchLabels': match_labels}},
+                'status': {'disruptionsAllowed': disruptions_allowed, 'currentHealthy': 0, 'desiredHealthy': 0,
+                           'expectedPods': 0, 'observedGeneration': 1}
+            }
+            self.pdbs[(namespace, name)] = pdb
+            self._emit('poddisruptionbudgets', 'ADDED', pdb)
+
+    def _at(self, delay, func):
+        if delay <= 0:
+            func()
+        else:
+            timer = threading.Timer(delay, func)
+            timer.daemon = True
+            timer.start()
+
+    def _matching_pdbs(self, pod):
+        labels = pod['metadata'].get('labels') or {}
+        return [pdb for (namespace, _), pdb in self.pdbs.items()
+                if namespace == pod['metadata']['namespace']
+                and all(labels.get(k) == v for k, v in pdb['spec']['selector']['matchLabels'].items())]
+
+    def _remove_pod(self, key):
+        with self.lock:
+            pod = self.pods.pop(key, None)
+            if pod is not None:
+                self._emit('pods', 'DELETED', pod)
+
+    def _restore_budget(self, key):
+        with self.lock:
+            pdb = self.pdbs.get(key)
+            if pdb is not None:
+                pdb['status']['disruptionsAllowed'] += 1
+                self._emit('poddisruptionbudgets', 'MODIFIED', pdb)
+
+    def _termination_delay(self, key, grace_period_seconds):
+        # must be called with the lock held. A requested grace period replaces the pod's own, even a longer one
+        delay = self.termination_delays.get(key, self.termination_delay)
+        if grace_period_seconds is None:
+            grace_period_seconds = self.pods[key]['spec'].get('terminationGracePeriodSeconds')
+        return delay if grace_period_seconds is None else min(delay, grace_period_seconds)
+
+    def evict(self, namespace, name, grace_period_seconds=None):
+        key = (namespace, name)
+        with self.lock:
+            pod = self.pods.get(key)
+            if pod is None:
+                return 404
+            if pod['metadata'].get('deletionTimestamp'):
+                return 201
+            if self.random.random() < self.rate_429:
+                return 429
+            pdbs = self._matching_pdbs(pod)
+            if any(pdb['status']['disruptionsAllowed'] <= 0 for pdb in pdbs):
+                return 429
+            for pdb in pdbs:
+                pdb['status']['disruptionsAllowed'] -= 1
+                self._emit('poddisruptionbudgets', 'MODIFIED', pdb)
+                pdb_key = (pdb['metadata']['namespace'], pdb['metadata']['name'])
+                # the replacement pod becomes ready somewhere else after a while
+                self._at(self.replacement_delay, lambda pdb_key=pdb_key: self._restore_budget(pdb_key))
+            pod['metadata']['deletionTimestamp'] = '1970-01-01T00:00:00Z'
+            self._emit('pods', 'MODIFIED', pod)
+            delay = self._termination_delay(key, grace_period_seconds)
+        self._at(delay, lambda: self._remove_pod(key))
+        return 201
+
+    def delete(self, namespace, name, grace_period_seconds=None):
+        key = (namespace, name)
+        with self.lock:
+            if key not in self.pods:
+                return 404
+            delay = self._termination_delay(key, grace_period_seconds)
+        self._at(delay, lambda: self._remove_pod(key))
+        return 200
+
+    def patch_node(self, name, patch):
+        with self.lock:
+            node = self.nodes.get(name)
+            if node is None:
+                return 404, None
+            expected = patch.get('metadata', {}).pop('resourceVersion', None)
+            if expected is not None and expected != node['metadata']['resourceVersion']:
+                return 409, None
+            merge_patch(node, patch)
+            self._emit('nodes', 'MODIFIED', node)
+            return 200, node
+
+    # reads
+
+    def stats(self):
+        with self.lock:
+            return {'calls': dict(self.calls), 'bytes_sent': self.bytes_sent,
+                    'pods': len(self.pods), 'nodes': dict((name, node['metadata'].get('labels')) for name, node in self.nodes.items())}
+
+    def collection(self, kind):
+        return {'pods': self.pods, 'nodes': self.nodes, 'poddisruptionbudgets': self.pdbs}[kind]
+
+    def list(self, kind, selector, limit, continue_token):
+        with self.lock:
+            items = [obj for _, obj in sorted(self.collection(kind).items()) if selector(obj)]
+            start = int(continue_token or 0)
+            end = start + limit if limit else len(items)
+            page = items[start:end]
+            metadata = {'resourceVersion': str(self.resource_version)}
+            if end < len(items):
+                metadata['continue'] = str(end)
+            return {'kind': 'List', 'apiVersion': 'v1', 'metadata': metadata, 'items': page}
+
+    def watch(self, kind, selector, resource_version, deadline):
+        """Yields the events of the kind after resource_version until the deadline."""
+        position = 0
+        while True:
+            with self.lock:
+                pending = [event for event in self.events[position:]
+                           if event[0] > resource_version and event[1] == kind and selector(event[3])]
+                position = len(self.events)
+                if not pending:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return
+                    self.lock.wait(remaining)
+                    continue
+            for _, _, event_type, obj in pending:
+                yield {'type': event_type, 'object': obj}
+
+
+def merge_patch(target, patch):
+    for key, value in patch.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge_patch(target[key], value)
+        elif value is None:
+            target.pop(key, None)
+        else:
+            target[key] = value
+
+
+def field_selector(query):
+    """Builds a predicate from the equality-based fieldSelector of the query."""
+    conditions = []
+    for term in filter(None, (query.get('fieldSelector') or [''])[0].split(',')):
+        path, value = term.split('=', 1)
+        conditions.append((path.split('.'), value))
+
+    def matches(obj):
+        for path, value in conditions:
+            current = obj
+            for part in path:
+                current = (current or {}).get(part)
+            if current != value:
+                return False
+        return True
+    return matches
+
+
+class FakeKubernetesHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def cluster(self):
+        return self.server.cluster
+
+    def log_message(self, format, *args):
+        pass
+
+    def _count(self, verb, resource):
+        with self.cluster.lock:
+            self.cluster.calls[verb + ' ' + resource] += 1
+        if self.cluster.latency:
+            time.sleep(self.cluster.latency)
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        with self.cluster.lock:
+            self.cluster.bytes_sent += len(data)
+
+    def _status(self, code, reason):
+        self._send(code, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Failure', 'reason': reason, 'code': code})
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == STATS_PATH:
+            return self._send(200, self.cluster.stats())
+        if PODS_PATH.match(url.path):
+            kind = 'pods'
+        elif NODES_PATH.match(url.path):
+            kind = 'nodes'
+            name = NODES_PATH.match(url.path).group('name')
+            if name:
+                self._count('get', kind)
+                with self.cluster.lock:
+                    node = self.cluster.nodes.get(name)
+                    body = json.loads(json.dumps(node)) if node is not None else None
+                return self._send(200, body) if body is not None else self._status(404, 'NotFound')
+        elif PDBS_PATH.match(url.path):
+            kind = 'poddisruptionbudgets'
+        else:
+            return self._status(404, 'NotFound')
+
+        selector = field_selector(query)
+        if (query.get('watch') or ['false'])[0] in ('true', '1', 'True'):
+            self._count('watch', kind)
+            return self._watch(kind, selector, query)
+
+        self._count('list', kind)
+        limit = int((query.get('limit') or ['0'])[0])
+        self._send(200, self.cluster.list(kind, selector, limit, (query.get('continue') or [None])[0]))
+
+    def _watch(self, kind, selector, query):
+        resource_version = int((query.get('resourceVersion') or ['0'])[0] or 0)
+        deadline = time.time() + int((query.get('timeoutSeconds') or ['60'])[0])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for event in self.cluster.watch(kind, selector, resource_version, deadline):
+                data = (json.dumps(event) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+                with self.cluster.lock:
+                    self.cluster.bytes_sent += len(data)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+    def do_PATCH(self):
+        match = NODES_PATH.match(urlparse(self.path).path)
+        if not match or not match.group('name'):
+            return self._status(404, 'NotFound')
+        self._count('patch', 'nodes')
+        status, node = self.cluster.patch_node(match.group('name'), self._read_body())
+        if node is None:
+            return self._status(status, 'Conflict' if status == 409 else 'NotFound')
+        self._send(status, node)
+
+    def do_POST(self):
+        match = NAMESPACED_POD_PATH.match(urlparse(self.path).path)
+        if not match or not match.group('eviction'):
+            return self._status(404, 'NotFound')
+        self._count('create', 'evictions')
+        delete_options = self._read_body().get('deleteOptions') or {}
+        status = self.cluster.evict(match.group('namespace'), match.group('name'), delete_options.get('gracePeriodSeconds'))
+        if status == 201:
+            self._send(201, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success', 'code': 201})
+        elif status == 429:
+            self._status(429, 'TooManyRequests')
+        else:
+            self._status(status, 'NotFound')
+
+    def do_DELETE(self):
+        match = NAMESPACED_POD_PATH.match(urlparse(self.path).path)
+        if not match or match.group('eviction'):
+            return self._status(404, 'NotFound')
+        self._count('delete', 'pods')
+        body = self._read_body()
+        status = self.cluster.delete(match.group('namespace'), match.group('name'), body.get('gracePeriodSeconds'))
+        if status == 200:
+            self._send(200, {'kind': 'Status', 'apiVersion': 'v1', 'status': 'Success', 'code': 200})
+        else:
+            self._status(status, 'NotFound')
+
+
+class FakeKubernetesServer(object):
+    """Serves a FakeCluster on a local port in a background thread."""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeKubernetesHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.cluster = cluster
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.httpd.server_port
+
+    def kubeconfig(self):
+        return '\n'.join([
+            'apiVersion: v1',
+            'kind: Config',
+            'clusters:',
+            '- name: fake',
+            '  cluster:',
+            '    server: ' + self.url,
+            'contexts:',
+            '- name: fake',
+            '  context:',
+            '    cluster: fake',
+            '    user: fake',
+            'current-context: fake',
+            'users:',
+            '- name: fake',
+            '  user:',
+            '    token: fake',
+            ''
+        ])
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,296 @@
+"""Load test of the lifecycle hook under bursts of lifecycle actions.
+
+Generates the SNS lifecycle messages of a scale-in, an instance refresh or a warm pool fill, or
+loads recorded ones, and publishes them at a fixed rate to lambda_handler with at most
+--concurrency invocations in flight, like reserved_concurrent_executions. The invocations run
+against the fake Kubernetes API server and AWS stand-ins of bench.py and share one process, like
+warm containers. It reports per-hook latency percentiles, the outcomes, the lifecycle actions that
+would have hit their heartbeat timeout and the API server request rates, and how much concurrency
+and Lambda timeout the burst needs.
+
+    AWS_REGION=us-east-1 python replay.py scale-in --hooks 50 --rate 120 --concurrency 10
+    AWS_REGION=us-east-1 python replay.py --events recorded.jsonl --rate 30
+"""
+import argparse
+import collections
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import ASG_NAME, FUNCTIONS_PATH, LAUNCHING, LIFECYCLE_HOOK_NAME, TERMINATING, instance_id, node_name
+
+
+def lifecycle_message(index, transition, destination='AutoScalingGroup'):
+    return {
+        'LifecycleHookName': LIFECYCLE_HOOK_NAME,
+        'AutoScalingGroupName': ASG_NAME,
+        'LifecycleTransition': transition,
+        'EC2InstanceId': instance_id(index),
+        'Destination': destination,
+        'LifecycleActionToken': 'token-%d-%s' % (index, transition.rsplit('_', 1)[-1].lower())
+    }
+
+
+def generate(options):
+    """Returns the lifecycle messages of the scenario in the order they are published."""
+    if options.scenario == 'scale-in':
+        return [lifecycle_message(index, TERMINATING) for index in range(options.hooks)]
+    if options.scenario == 'warm-pool':
+        return [lifecycle_message(index, LAUNCHING, 'WarmPool') for index in range(options.hooks)]
+
+    # an instance refresh launches each replacement before it terminates the instance it replaces
+    replacements = max(1, options.hooks // 2)
+    messages = []
+    for index in range(replacements):
+        messages.append(lifecycle_message(replacements + index, LAUNCHING))
+        messages.append(lifecycle_message(index, TERMINATING))
+    return messages
+
+
+def load(path):
+    """Loads lifecycle messages from a file of JSON lines, each a Lambda event, an SNS record or a
+    lifecycle message, and skips test notifications.
+    """
+    messages = []
+    with open(path) as f:
+        for line in filter(None, (line.strip() for line in f)):
+            document = json.loads(line)
+            records = document.get('Records') or [document]
+            for record in records:
+                message = json.loads(record['Sns']['Message']) if 'Sns' in record else record
+                if 'LifecycleTransition' in message:
+                    messages.append(message)
+    return messages
+
+
+def plan(messages, options):
+    """Assigns each instance a node and each message the offset it is published at."""
+    nodes = {}
+    entries = []
+    for index, message in enumerate(messages):
+        node = nodes.setdefault(message['EC2InstanceId'], node_name(len(nodes)))
+        entries.append({'message': message, 'node': node, 'offset': index * 60.0 / options.rate})
+    return entries
+
+
+def serve(entries, options, queue):
+    """Runs the fake Kubernetes API server in a child process and reports its URL."""
+    from fake_k8s import FakeCluster, FakeKubernetesServer
+
+    cluster = FakeCluster(latency=options.latency, rate_429=options.rate_429,
+                          termination_delay=options.termination_delay, seed=options.seed)
+    started = time.time()
+    for entry in entries:
+        node = entry['node']
+        if entry['message']['LifecycleTransition'] == LAUNCHING:
+            # the node registers and becomes Ready some time after its launching hook is published
+            cluster.add_node(node, register_after=entry['offset'] + options.register_after,
+                             ready_after=entry['offset'] + options.ready_after)
+            continue
+        cluster.add_node(node)
+        for pod in range(options.pods):
+            cluster.add_pod('replay', 'app-%s-%d' % (node, pod), node, labels={'app': 'app-%d' % (pod % 10)})
+        cluster.add_pod('kube-system', 'kube-proxy-%s' % node, node, owner_kind='DaemonSet')
+
+    with FakeKubernetesServer(cluster) as server:
+        queue.put((server.url, server.kubeconfig(), started))
+        while True:
+            time.sleep(3600)
+
+
+class ReplayContext(object):
+    """Stands in for the Lambda context, so that hooks keep to the Lambda timeout."""
+
+    def __init__(self, timeout):
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.time()) * 1000)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1)]
+
+
+def summarize(values):
+    return dict((name, round(percentile(values, fraction), 3))
+                for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)))
+
+
+def run(options):
+    messages = load(options.events) if options.events else generate(options)
+    entries = plan(messages, options)
+
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(entries, options, queue), daemon=True)
+    server.start()
+    url, kubeconfig, cluster_started = queue.get(timeout=60)
+
+    os.environ.setdefault('AWS_REGION', 'us-east-1')
+    os.environ.update({
+        'CLUSTER_NAME': 'replay',
+        'KUBE_CONFIG_BUCKET': 'replay',
+        'KUBE_CONFIG_OBJECT': 'kubeconfig',
+        'KUBERNETES_NODE_ROLE': 'worker',
+        'LAUNCHING_TIMEOUT': str(options.launching_timeout),
+        'TERMINATING_TIMEOUT': str(options.terminating_timeout),
+        'EVICTION_CONCURRENCY': str(options.eviction_concurrency),
+        'CONTINUATION_ENABLED': 'false'
+    })
+    sys.path.insert(0, FUNCTIONS_PATH)
+
+    import cache
+    import handler
+    import metrics
+    from fake_aws import FakeAccount, FakeAutoScaling, FakeEC2, FakeS3
+
+    if not options.emf:
+        # thousands of metric log lines would drown the report
+        metrics.Metrics.emit = lambda self: None
+
+    account = FakeAccount(ASG_NAME, latency=options.aws_latency)
+    for entry in entries:
+        state = 'Pending:Wait' if entry['message']['LifecycleTransition'] == LAUNCHING else 'Terminating:Wait'
+        account.add_instance(entry['message']['EC2InstanceId'], entry['node'], lifecycle_state=state)
+    account.desired_capacity = max(account.desired_capacity, 2)
+
+    handler.KUBE_FILEPATH = os.path.join(tempfile.mkdtemp(), 'kubeconfig')
+    handler.aws_clients.update({
+        'autoscaling': FakeAutoScaling(account),
+        'ec2': FakeEC2(account),
+        's3': FakeS3(account, kubeconfig)
+    })
+    cache.clear()
+
+    hooks = []
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def invoke(entry, published):
+        started = time.time()
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        event = {'Records': [{'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps(entry['message'])}}]}
+        try:
+            outcomes = handler.lambda_handler(event, ReplayContext(options.lambda_timeout))['outcomes']
+            result = outcomes[0]['result'] if outcomes else None
+        except Exception:
+            result = 'ERROR'
+        finished = time.time()
+        transition = entry['message']['LifecycleTransition']
+        heartbeat_timeout = options.launching_timeout if transition == LAUNCHING else options.terminating_timeout
+        with lock:
+            in_flight[0] -= 1
+            hooks.append({
+                'transition': transition,
+                'result': result,
+                'queued': started - published,
+                'duration': finished - started,
+                'total': finished - published,
+                'heartbeat_timeout': finished - published > heartbeat_timeout
+            })
+
+    # the offsets of the launching nodes count from when the fake cluster was built
+    started = max(time.time(), cluster_started)
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        for entry in entries:
+            delay = started + entry['offset'] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(invoke, entry, time.time())
+    elapsed = time.time() - started
+
+    with urllib.request.urlopen(url + '/_stats') as response:
+        stats = json.loads(response.read())
+    server.terminate()
+
+    durations = [hook['duration'] for hook in hooks]
+    arrival_rate = len(entries) / max(entries[-1]['offset'], 60.0 / options.rate) if entries else 0.0
+    p99 = percentile(durations, 0.99)
+    return {
+        'scenario': 'events' if options.events else options.scenario,
+        'hooks': len(hooks),
+        'wall_clock_seconds': round(elapsed, 3),
+        'throughput_per_minute': round(len(hooks) * 60.0 / elapsed, 1) if elapsed else 0.0,
+        'results': dict(collections.Counter(str(hook['result']) for hook in hooks)),
+        'results_by_transition': dict((transition.rsplit(':', 1)[-1], dict(collections.Counter(
+            str(hook['result']) for hook in hooks if hook['transition'] == transition))) for transition in (LAUNCHING, TERMINATING)),
+        'heartbeat_timeouts': sum(1 for hook in hooks if hook['heartbeat_timeout']),
+        'duration_seconds': summarize(durations),
+        'queued_seconds': summarize([hook['queued'] for hook in hooks]),
+        'total_seconds': summarize([hook['total'] for hook in hooks]),
+        'peak_concurrency': in_flight[1],
+        'kubernetes_requests_per_second': dict((call, round(count / elapsed, 2)) for call, count in sorted(stats['calls'].items())),
+        'kubernetes_requests_per_hook': round(sum(stats['calls'].values()) / float(max(1, len(hooks))), 1),
+        'aws_calls': dict(account.calls),
+        # Little's law: the invocations in flight are the arrival rate times how long each one runs, but never
+        # more than the hooks of the burst
+        'suggested_reserved_concurrent_executions': min(len(hooks), int(math.ceil(arrival_rate * p99))),
+        'suggested_lambda_timeout': int(math.ceil(p99 * 1.5 / 60.0) * 60) if durations else 0
+    }
+
+
+def report(results):
+    print('scenario            %s' % results['scenario'])
+    print('hooks               %d in %.1fs (%.1f per minute)' % (results['hooks'], results['wall_clock_seconds'],
+                                                               results['throughput_per_minute']))
+    print('results             %s' % ', '.join('%s=%d' % item for item in sorted(results['results'].items())))
+    for transition, counts in sorted(results['results_by_transition'].items()):
+        if counts:
+            print('  %-17s %s' % (transition.lower(), ', '.join('%s=%d' % item for item in sorted(counts.items()))))
+    print('heartbeat timeouts  %d' % results['heartbeat_timeouts'])
+    print('peak concurrency    %d' % results['peak_concurrency'])
+    print('latency (s)         p50      p90      p99      max')
+    for name in ('duration', 'queued', 'total'):
+        values = results[name + '_seconds']
+        print('  %-17s %-8.3f %-8.3f %-8.3f %-8.3f' % (name, values['p50'], values['p90'], values['p99'], values['max']))
+    print('kubernetes requests %.1f per hook' % results['kubernetes_requests_per_hook'])
+    for call, rate in sorted(results['kubernetes_requests_per_second'].items()):
+        print('  %-30s %.2f/s' % (call, rate))
+    print('suggested reserved_concurrent_executions >= %d' % results['suggested_reserved_concurrent_executions'])
+    print('suggested lambda_timeout                 >= %d' % results['suggested_lambda_timeout'])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('scenario', nargs='?', default='scale-in', choices=['scale-in', 'instance-refresh', 'warm-pool'])
+    parser.add_argument('--events', help='replay the lifecycle messages of a JSON lines file instead')
+    parser.add_argument('--hooks', type=int, default=20, help='lifecycle hooks to generate')
+    parser.add_argument('--rate', type=float, default=60, help='lifecycle hooks published per minute')
+    parser.add_argument('--concurrency', type=int, default=10, help='invocations in flight, as reserved_concurrent_executions')
+    parser.add_argument('--pods', type=int, default=30, help='evictable pods per terminating node')
+    parser.add_argument('--latency', type=float, default=0.0, help='Kubernetes API latency in seconds')
+    parser.add_argument('--aws-latency', type=float, default=0.0, help='AWS API latency in seconds')
+    parser.add_argument('--rate-429', type=float, default=0.0, help='probability an eviction is rejected')
+    parser.add_argument('--termination-delay', type=float, default=0.5, help='seconds an evicted pod takes to go away')
+    parser.add_argument('--register-after', type=float, default=0.5, help='seconds until a launching node registers')
+    parser.add_argument('--ready-after', type=float, default=2.0, help='seconds until a launching node is Ready')
+    parser.add_argument('--eviction-concurrency', type=int, default=10, help='EVICTION_CONCURRENCY')
+    parser.add_argument('--launching-timeout', type=float, default=550, help='heartbeat timeout of launching hooks')
+    parser.add_argument('--terminating-timeout', type=float, default=850, help='heartbeat timeout of terminating hooks')
+    parser.add_argument('--lambda-timeout', type=float, default=900, help='timeout of each invocation')
+    parser.add_argument('--emf', action='store_true', help='print the metric log lines of the hooks')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    results = run(options)
+    if options.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
@@ -0,0 +1,64 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+INSTANCE_TTL = 300  # Private DNS name and lifecycle of an instance never change
+ASG_TTL = 5  # Desired capacity and instance states change during scaling
+KUBECONFIG_ETAG_TTL = 60  # How often to check the S3 kubeconfig object for changes
+
+# Module level state survives across invocations of a warm Lambda container
+_entries = {}
+_lock = threading.Lock()
+
+
+def cached(key, ttl, loader):
+    """Returns the cached value of the key, or calls loader and caches its result for ttl seconds."""
+    now = time.time()
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+
+    value = loader()
+    with _lock:
+        _entries[key] = (now + ttl, value)
+    return value
+
+
+def put(key, value, ttl=float('inf')):
+    with _lock:
+        _entries[key] = (time.time() + ttl, value)
+
+
+def get(key):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+    return None
+
+
+def invalidate(key):
+    with _lock:
+        _entries.pop(key, None)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def describe_instance(ec2_client, instance_id):
+    """Returns the EC2 instance description, cached for INSTANCE_TTL seconds."""
+    return cached(('instance', instance_id), INSTANCE_TTL, lambda: ec2_client.describe_instances(
+        InstanceIds=[instance_id])['Reservations'][0]['Instances'][0])
+
+
+def describe_auto_scaling_group(asg_client, asg_name):
+    """Returns the auto scaling group description, cached for ASG_TTL seconds."""
+    return cached(('asg', asg_name), ASG_TTL, lambda: asg_client.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[asg_name])['AutoScalingGroups'][0])
+
@@ -0,0 +1,201 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+IN_PROGRESS = 'IN_PROGRESS'
+COMPLETED = 'COMPLETED'
+
+DEFAULT_TTL = 3600  # Keep completed outcomes long enough to absorb SNS and Lambda retries
+DEFAULT_CLAIM_TTL = 900  # A claim outlives the longest invocation, after which a crashed one is retried
+
+
+def key(hook_payload):
+    """Returns the key which identifies a lifecycle message and its duplicates. Every continuation
+    of a lifecycle action is a step of its own.
+    """
+    attempt = (hook_payload.get('Continuation') or {}).get('Attempt', 0)
+    return '/'.join([hook_payload.get('LifecycleActionToken') or '-', hook_payload['EC2InstanceId'],
+                     hook_payload['LifecycleTransition'], str(attempt)])
+
+
+def drain_key(instance_id):
+    """Returns the key which claims the drain of an instance, shared by its spot interruption
+    events and its terminating lifecycle action so that only one of them drains the node.
+    """
+    return 'drain/' + instance_id
+
+
+class MemoryStore(object):
+    """Keeps the records in the Lambda container, where they survive across warm invocations.
+    Duplicates processed by the same container wait on the in progress record instead of polling.
+    """
+
+    def __init__(self):
+        self.records = {}
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def _live(self, key, now):
+        record = self.records.get(key)
+        if record is not None and record['ExpiresAt'] <= now:
+            del self.records[key]
+            return None
+        return record
+
+    def claim(self, key, ttl):
+        """Claims the key and returns None, or returns the record of whoever claimed it first."""
+        now = time.time()
+        with self.lock:
+            record = self._live(key, now)
+            if record is not None:
+                return dict(record)
+            self.records[key] = {'Status': IN_PROGRESS, 'ExpiresAt': now + ttl}
+            self.events[key] = threading.Event()
+        return None
+
+    def complete(self, key, outcome, ttl):
+        with self.lock:
+            self.records[key] = {'Status': COMPLETED, 'Outcome': outcome, 'ExpiresAt': time.time() + ttl}
+            event = self.events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def release(self, key):
+        with self.lock:
+            self.records.pop(key, None)
+            event = self.events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def get(self, key):
+        with self.lock:
+            record = self._live(key, time.time())
+            return dict(record) if record is not None else None
+
+    def wait(self, key, timeout):
+        """Waits up to timeout seconds for the in progress record to complete or be released."""
+        with self.lock:
+            event = self.events.get(key)
+        if event is not None:
+            event.wait(timeout)
+        return self.get(key)
+
+
+class FileStore(object):
+    """Keeps the records in a JSON file shared by the processes of one host, for local testing."""
+
+    def __init__(self, path, poll=1):
+        self.path = path
+        self.poll = poll
+
+    def _update(self, func):
+        # hold an exclusive lock for the whole read, modify and write
+        with os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600), 'r+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                now = time.time()
+                records = dict((k, r) for k, r in (json.loads(content) if content else {}).items() if r['ExpiresAt'] > now)
+                result = func(records)
+                f.seek(0)
+                f.truncate()
+                json.dump(records, f)
+                f.flush()
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def claim(self, key, ttl):
+        def claim_record(records):
+            if key in records:
+                return records[key]
+            records[key] = {'Status': IN_PROGRESS, 'ExpiresAt': time.time() + ttl}
+            return None
+        return self._update(claim_record)
+
+    def complete(self, key, outcome, ttl):
+        self._update(lambda records: records.update({key: {'Status': COMPLETED, 'Outcome': outcome,
+                                                           'ExpiresAt': time.time() + ttl}}))
+
+    def release(self, key):
+        self._update(lambda records: records.pop(key, None))
+
+    def get(self, key):
+        return self._update(lambda records: records.get(key))
+
+    def wait(self, key, timeout):
+        return poll_until_done(self, key, timeout, self.poll)
+
+
+class DynamoDBStore(object):
+    """Keeps the records in a DynamoDB table, or any store with the same API, whose partition key is
+    Key and whose time to live attribute is ExpiresAt. Claims are conditional writes, so exactly one
+    of the concurrent invocations processing a message claims it.
+    """
+
+    def __init__(self, client, table_name, poll=2):
+        self.client = client
+        self.table_name = table_name
+        self.poll = poll
+
+    def claim(self, key, ttl):
+        now = time.time()
+        try:
+            self.client.put_item(
+                TableName=self.table_name,
+                Item={'Key': {'S': key}, 'Status': {'S': IN_PROGRESS}, 'ExpiresAt': {'N': str(int(now + ttl))}},
+                # expired items linger until DynamoDB deletes them, so they can be claimed again
+                ConditionExpression='attribute_not_exists(#key) OR ExpiresAt < :now',
+                ExpressionAttributeNames={'#key': 'Key'},
+                ExpressionAttributeValues={':now': {'N': str(int(now))}})
+            return None
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'ConditionalCheckFailedException':
+                raise
+        return self.get(key) or {'Status': IN_PROGRESS}
+
+    def complete(self, key, outcome, ttl):
+        self.client.put_item(
+            TableName=self.table_name,
+            Item={'Key': {'S': key}, 'Status': {'S': COMPLETED}, 'Outcome': {'S': json.dumps(outcome)},
+                  'ExpiresAt': {'N': str(int(time.time() + ttl))}})
+
+    def release(self, key):
+        self.client.delete_item(TableName=self.table_name, Key={'Key': {'S': key}})
+
+    def get(self, key):
+        item = self.client.get_item(TableName=self.table_name, Key={'Key': {'S': key}}, ConsistentRead=True).get('Item')
+        if item is None or float(item['ExpiresAt']['N']) <= time.time():
+            return None
+        record = {'Status': item['Status']['S'], 'ExpiresAt': float(item['ExpiresAt']['N'])}
+        if 'Outcome' in item:
+            record['Outcome'] = json.loads(item['Outcome']['S'])
+        return record
+
+    def wait(self, key, timeout):
+        return poll_until_done(self, key, timeout, self.poll)
+
+
+def poll_until_done(store, key, timeout, poll):
+    deadline = time.time() + timeout
+    while True:
+        record = store.get(key)
+        if record is None or record['Status'] != IN_PROGRESS or time.time() + poll > deadline:
+            return record
+        time.sleep(poll)
+
+
+def from_env(aws_client):
+    """Returns the store configured by DEDUP_TABLE or DEDUP_FILE, or a store in memory."""
+    if os.environ.get('DEDUP_TABLE'):
+        return DynamoDBStore(aws_client('dynamodb'), os.environ['DEDUP_TABLE'])
+    if os.environ.get('DEDUP_FILE'):
+        return FileStore(os.environ['DEDUP_FILE'])
+    return MemoryStore()
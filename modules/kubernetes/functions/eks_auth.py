@@ -0,0 +1,106 @@
+import base64
+import logging
+import threading
+
+import cache
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TOKEN_PREFIX = 'k8s-aws-v1.'
+CLUSTER_ID_HEADER = 'x-k8s-aws-id'
+TOKEN_EXPIRES_IN = 60  # Validity of the presigned URL, which EKS accepts for 15 minutes
+TOKEN_TTL = 14 * 60  # Mint a new token a minute before EKS stops accepting the cached one
+
+# Arguments naming the cluster in `aws eks get-token` and `aws-iam-authenticator token`
+CLUSTER_NAME_ARGS = ('--cluster-name', '--cluster-id', '-i')
+# Arguments making the plugin sign as another identity than the Lambda's, as `--arg value` or `--arg=value`
+IDENTITY_ARGS = ('--role-arn', '--role', '-r', '--profile')
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def botocore_session():
+
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import botocore.session
+                _session = botocore.session.get_session()
+    return _session
+
+
+def exec_cluster_name(user):
+    """Returns the cluster name if the kubeconfig user authenticates with `aws eks get-token` or
+    `aws-iam-authenticator token` as the identity of the Lambda, or None.
+    """
+    plugin = (user or {}).get('exec')
+    if not plugin:
+        return None
+    args = plugin.get('args') or []
+    command = plugin.get('command', '').rsplit('/', 1)[-1]
+    if not (command == 'aws' and 'get-token' in args) and not (command == 'aws-iam-authenticator' and 'token' in args):
+        return None
+    # tokens of an assumed role or another profile need the plugin to sign them, and so does an
+    # environment, which may set AWS_PROFILE, AWS_ROLE_ARN or other credentials
+    if plugin.get('env') or any(arg.split('=', 1)[0] in IDENTITY_ARGS for arg in args):
+        return None
+    for index, arg in enumerate(args[:-1]):
+        if arg in CLUSTER_NAME_ARGS:
+            return args[index + 1]
+    return None
+
+
+def mint_token(cluster_name, region):
+    """Presigns an STS GetCallerIdentity request for the cluster, which is what EKS verifies a
+    bearer token with, without running the exec plugin in a subprocess.
+    """
+    from botocore.signers import RequestSigner
+
+    session = botocore_session()
+    signer = RequestSigner(session.get_service_model('sts').service_id, region, 'sts', 'v4',
+                           session.get_credentials(), session.get_component('event_emitter'))
+    with metrics.timer('EksTokenTime'):
+        url = signer.generate_presigned_url({
+            'method': 'GET',
+            'url': 'https://sts.{}.amazonaws.com/?Action=GetCallerIdentity&Version=2011-06-15'.format(region),
+            'body': {},
+            'headers': {CLUSTER_ID_HEADER: cluster_name},
+            'context': {}
+        }, region_name=region, expires_in=TOKEN_EXPIRES_IN, operation_name='')
+    metrics.count('EksTokensMinted')
+    return TOKEN_PREFIX + base64.urlsafe_b64encode(url.encode('utf-8')).decode('utf-8').rstrip('=')
+
+
+def get_token(cluster_name, region):
+    """Returns the bearer token of the cluster, cached for TOKEN_TTL seconds."""
+    return cache.cached(('eks_token', cluster_name, region), TOKEN_TTL, lambda: mint_token(cluster_name, region))
+
+
+def use_token(configuration, cluster_name, region):
+    """Authenticates the client configuration with in-process tokens, refreshed before every
+    request once the cached token is about to expire.
+    """
+    def refresh(configuration):
+        configuration.api_key['authorization'] = get_token(cluster_name, region)
+
+    configuration.api_key_prefix['authorization'] = 'Bearer'
+    configuration.refresh_api_key_hook = refresh
+    refresh(configuration)
+
+
+def strip_exec_plugin(config_dict):
+    """Removes the exec plugin of the kubeconfig's current user if it mints EKS tokens for the
+    identity of the Lambda, and returns the name of its cluster, or None if it was left in place.
+    """
+    contexts = dict((context['name'], context.get('context') or {}) for context in config_dict.get('contexts') or [])
+    users = dict((user['name'], user.get('user')) for user in config_dict.get('users') or [])
+    user = users.get(contexts.get(config_dict.get('current-context'), {}).get('user'))
+
+    cluster_name = exec_cluster_name(user)
+    if cluster_name is not None:
+        user.pop('exec')
+    return cluster_name
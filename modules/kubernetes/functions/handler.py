@@ -1,139 +1,560 @@
-import boto3
 import json
 import logging
 import os.path
+import threading
 import time
 
-from botocore.signers import RequestSigner
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
 from kubernetes import client as k8s_client
 from kubernetes import config as k8s_config
-from kubernetes.client.rest import ApiException
+import yaml
 
-from k8s_utils import (abandon_lifecycle_action, continue_lifecycle_action, cordon_node, node_exists, node_ready, append_node_labels, master_ready, remove_all_pods, exclude_node_from_loadbalancer)
+import cache
+import dedup
+import eks_auth
+import metrics
+import retry
+from k8s_utils import (abandon_lifecycle_action, continue_lifecycle_action, node_exists, node_ready, node_labels, master_ready, remove_all_pods, new_drain_state, drain_step, NodeMutation, DrainPolicy, DEFAULT_EVICTION_CONCURRENCY, DRAIN_PHASE_DONE, EXCLUDE_FROM_LOAD_BALANCERS_LABEL_KEY)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 KUBE_FILEPATH = '/tmp/kubeconfig'
+LIFECYCLE_ACTION_CONTINUE = 'CONTINUE'
+LIFECYCLE_ACTION_ABANDON = 'ABANDON'
+LIFECYCLE_ACTION_RESCHEDULED = 'RESCHEDULED'
 REGION = os.environ['AWS_REGION']
 
-ec2 = boto3.client('ec2', region_name=REGION)
-asg = boto3.client('autoscaling', region_name=REGION)
-elb = boto3.client('elb', region_name=REGION)
-s3  = boto3.client('s3', region_name=REGION)
+SPOT_INTERRUPTION_WARNING = 'EC2 Spot Instance Interruption Warning'
+REBALANCE_RECOMMENDATION = 'EC2 Instance Rebalance Recommendation'
+SPOT_INTERRUPTION_NOTICE = 120  # Seconds between the interruption warning and the reclaim of the instance
+SPOT_EVICTION_CONCURRENCY = 50
+SPOT_EVICTION_TIMEOUT = 30
+SPOT_TERMINATION_TIMEOUT = 60
+SPOT_GRACE_PERIOD = 20  # Evicted pods have to terminate well within the interruption notice
 
-def hook_init(hook_payload):
+# boto3 clients are created on first use, so worker nodes never build the elb client and
+# warm invocations rarely need the s3 one
+aws_clients = {}
+aws_clients_lock = threading.Lock()
 
-    hook_info = {
+k8s_init_lock = threading.Lock()
+
+# records which lifecycle messages were processed, so that duplicate deliveries aren't processed again
+dedup_stores = []
+dedup_stores_lock = threading.Lock()
+
+def aws_client(service_name):
+
+    client = aws_clients.get(service_name)
+    if client is None:
+        with aws_clients_lock:
+            client = aws_clients.get(service_name)
+            if client is None:
+                import boto3
+                client = metrics.instrument_boto3_client(boto3.client(service_name, region_name=REGION))
+                aws_clients[service_name] = client
+    return client
+
+def dedup_store():
+
+    if not dedup_stores:
+        with dedup_stores_lock:
+            if not dedup_stores:
+                dedup_stores.append(dedup.from_env(aws_client))
+    return dedup_stores[0]
+
+def resolve_k8s_api(k8s_api):
+
+    # the kubernetes client may still be initializing in another thread
+    if isinstance(k8s_api, Future):
+        return k8s_api.result()
+    return k8s_api
+
+def hook_env():
+
+    return {
         'cluster_name': os.environ.get('CLUSTER_NAME'),
         'kube_config_bucket': os.environ.get('KUBE_CONFIG_BUCKET'),
         'kube_config_object': os.environ.get('KUBE_CONFIG_OBJECT'),
         'node_role': os.environ.get('KUBERNETES_NODE_ROLE'),
+        'autoscaling_group_name': os.environ.get('AUTOSCALING_GROUP_NAME'),
         'launching_timeout': float(os.environ.get('LAUNCHING_TIMEOUT')),
-        'terminating_timeout': float(os.environ.get('TERMINATING_TIMEOUT'))
+        'terminating_timeout': float(os.environ.get('TERMINATING_TIMEOUT')),
+        'eviction_concurrency': int(os.environ.get('EVICTION_CONCURRENCY', DEFAULT_EVICTION_CONCURRENCY)),
+        'continuation_enabled': os.environ.get('CONTINUATION_ENABLED', 'false').lower() == 'true',
+        'continuation_interval': int(os.environ.get('CONTINUATION_INTERVAL', 60)),
+        'lifecycle_topic_arn': os.environ.get('LIFECYCLE_TOPIC_ARN'),
+        'continuation_role_arn': os.environ.get('CONTINUATION_ROLE_ARN'),
+        'drain_policy': DrainPolicy(os.environ.get('DRAIN_ORDER') or 'default',
+                                    int(os.environ['JOB_GRACE_PERIOD']) if os.environ.get('JOB_GRACE_PERIOD') else None,
+                                    os.environ.get('DRAIN_WAIT_FOR_JOBS', 'true').lower() == 'true')
     }
 
+def hook_init(hook_payload, k8s_api=None):
+
+    hook_info = hook_env()
+
     hook_info['name'] = hook_payload['LifecycleHookName']
     hook_info['asg_name'] = hook_payload['AutoScalingGroupName']
     hook_info['transition'] = hook_payload['LifecycleTransition']
     hook_info['instance_id'] = hook_payload['EC2InstanceId']
     hook_info['destination'] = hook_payload['Destination']
+    hook_info['payload'] = hook_payload
+    # the progress of a lifecycle action continued from a previous invocation
+    hook_info['continuation'] = hook_payload.get('Continuation')
 
-    instance = ec2.describe_instances(InstanceIds=[hook_info['instance_id']])['Reservations'][0]['Instances'][0]
+    with metrics.timer('HookInitTime'):
+        instance = cache.describe_instance(aws_client('ec2'), hook_info['instance_id'])
 
     hook_info['node_name'] = instance['PrivateDnsName']
     hook_info['instance_lifecycle'] = 'Ec2Spot' if 'InstanceLifecycle' in instance else 'OnDemand'
 
     logger.info("Processing %s event from auto scaling group %s, and the instance id is %s, private dns name is %s" % (hook_info['transition'], hook_info['asg_name'], hook_info['instance_id'], hook_info['node_name']))
 
-    if not os.path.exists(KUBE_FILEPATH):
+    if k8s_api is None:
+        k8s_api = k8s_init(hook_info)
+
+    return resolve_k8s_api(k8s_api), hook_info
+
+def kubeconfig_etag(hook_info):
+
+    if not hook_info['kube_config_bucket']:
+        return None
+
+    return cache.cached(('kubeconfig_etag', hook_info['kube_config_bucket'], hook_info['kube_config_object']), cache.KUBECONFIG_ETAG_TTL,
+                        lambda: aws_client('s3').head_object(Bucket=hook_info['kube_config_bucket'], Key=hook_info['kube_config_object'])['ETag'])
+
+def k8s_init(hook_info, workers=1):
+
+    pool_size = hook_info['eviction_concurrency'] * workers
+
+    with k8s_init_lock:
+        etag = kubeconfig_etag(hook_info)
+
+        # reuse the client, and its keep-alive connections, of previous invocations in this container
+        cached_client = cache.get('k8s_api')
+        if cached_client is not None and cached_client['etag'] == etag and cached_client['pool_size'] >= pool_size and os.path.exists(KUBE_FILEPATH):
+            return cached_client['api']
+
         if hook_info['kube_config_bucket']:
-            logger.info('No kubeconfig file found. Downloading...')
-            s3.download_file(hook_info['kube_config_bucket'], hook_info['kube_config_object'], KUBE_FILEPATH)
-        else:
+            if not os.path.exists(KUBE_FILEPATH) or cache.get('kubeconfig_file_etag') != etag:
+                logger.info('No kubeconfig file found or it has changed. Downloading...')
+                with metrics.timer('KubeconfigDownloadTime'):
+                    aws_client('s3').download_file(hook_info['kube_config_bucket'], hook_info['kube_config_object'], KUBE_FILEPATH)
+                cache.put('kubeconfig_file_etag', etag)
+        elif not os.path.exists(KUBE_FILEPATH):
             logger.info('No kubeconfig file found.')
 
-    k8s_config.load_kube_config(KUBE_FILEPATH)
+        # Size the connection pool so that concurrent evictions don't queue on the pool
+        with metrics.timer('KubeconfigLoadTime'):
+            configuration = k8s_client.Configuration()
+            with open(KUBE_FILEPATH) as f:
+                config_dict = yaml.safe_load(f)
+
+            # mint EKS tokens in-process instead of running `aws eks get-token` for every client
+            cluster_name = eks_auth.strip_exec_plugin(config_dict)
+            if cluster_name is None:
+                k8s_config.load_kube_config(KUBE_FILEPATH, client_configuration=configuration)
+            else:
+                k8s_config.load_kube_config_from_dict(config_dict, client_configuration=configuration)
+                eks_auth.use_token(configuration, cluster_name, REGION)
+            configuration.connection_pool_maxsize = max(configuration.connection_pool_maxsize, pool_size)
+
+            api = k8s_client.CoreV1Api(metrics.instrument_api_client(k8s_client.ApiClient(configuration)))
+        cache.put('k8s_api', {'etag': etag, 'pool_size': configuration.connection_pool_maxsize, 'api': api})
+
+        return api
+
+def schedule_continuation(hook_info, continuation):
+
+    if not hook_info['continuation_enabled'] or not hook_info['lifecycle_topic_arn'] or not hook_info['continuation_role_arn']:
+        return False
 
-    return k8s_client.CoreV1Api(), hook_info
+    continuation = dict(continuation, Attempt=continuation.get('Attempt', 0) + 1)
+    payload = dict(hook_info['payload'], Continuation=continuation)
+    at = datetime.fromtimestamp(time.time() + hook_info['continuation_interval'], timezone.utc)
+    kind = 'launch' if hook_info['transition'] == 'autoscaling:EC2_INSTANCE_LAUNCHING' else 'terminate'
+
+    try:
+        # keep the lifecycle action from timing out while nothing runs for it
+        aws_client('autoscaling').record_lifecycle_action_heartbeat(LifecycleHookName=hook_info['name'], AutoScalingGroupName=hook_info['asg_name'], InstanceId=hook_info['instance_id'])
+        aws_client('scheduler').create_schedule(
+            Name='{}-{}-{}'.format(hook_info['instance_id'], kind, continuation['Attempt']),
+            ScheduleExpression='at({})'.format(at.strftime('%Y-%m-%dT%H:%M:%S')),
+            ScheduleExpressionTimezone='UTC',
+            FlexibleTimeWindow={'Mode': 'OFF'},
+            ActionAfterCompletion='DELETE',
+            Target={
+                'Arn': hook_info['lifecycle_topic_arn'],
+                'RoleArn': hook_info['continuation_role_arn'],
+                'Input': json.dumps(payload)
+            })
+    except Exception as e:
+        # a retried invocation finds the schedule of its first attempt
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') != 'ConflictException':
+            logger.exception('Unable to schedule the continuation of the {} of instance {}'.format(kind, hook_info['instance_id']))
+            return False
+
+    logger.info('Scheduled attempt {} of the {} of instance {} at {}'.format(continuation['Attempt'], kind, hook_info['instance_id'], at.isoformat()))
+    metrics.count('Continuations')
+    return True
 
 def launch_node(k8s_api, hook_info):
 
-    asg_desired_capacity = asg.describe_auto_scaling_groups(
-        AutoScalingGroupNames=[hook_info['asg_name']]
-    )['AutoScalingGroups'][0]['DesiredCapacity']
+    asg = aws_client('autoscaling')
 
-    if 'master' in hook_info['node_role'] and asg_desired_capacity == 1:
+    # only a master node looks up the capacity of its group, so a worker goes straight to its node
+    if 'master' in hook_info['node_role'] and cache.describe_auto_scaling_group(asg, hook_info['asg_name'])['DesiredCapacity'] == 1:
         continue_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
+        return LIFECYCLE_ACTION_CONTINUE
 
     else:
-        if hook_info['destination'] == 'WarmPool':
-            cordon_timeout = time.time() + hook_info['launching_timeout']
-            loop = True
-            while loop:
-                try:
-                    cordon_node(k8s_api, hook_info['node_name'])
-                    loop = False
-                except:
-                    logger.warning('Attempting to cordon node {} failed, retrying ...'.format(hook_info['node_name']))
-                    pass
-                if time.time() < cordon_timeout:
-                    time.sleep(1)
-                else:
-                    logger.exception('Exceeded the timeout of node {} cordoning, abandoning ...'.format(hook_info['node_name']))
-                    abandon_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
-
-            logger.info('Succeed in cordoning node {} in the warm pool.'.format(hook_info['node_name']))
-
-        if node_ready(k8s_api, hook_info['node_name'], hook_info['launching_timeout']):
-            append_node_labels(k8s_api, hook_info['node_name'], hook_info['node_role'], hook_info['instance_lifecycle'])
-            logger.info('Success to append labels to node {}.'.format(hook_info['node_name']))
+        continuation = hook_info['continuation']
+        warm_pool = hook_info['destination'] == 'WarmPool'
+        started = time.time()
+
+        # label the node, and cordon it in the warm pool, the moment it registers rather than once it is ready
+        mutation = NodeMutation(hook_info['node_name'])
+        if warm_pool:
+            mutation.cordon()
+        for key, value in node_labels(hook_info['node_role'], hook_info['instance_lifecycle']).items():
+            mutation.label(key, value)
+
+        registered = []
+
+        def on_registered():
+            # a second wait for the node in this invocation doesn't patch it again
+            if registered:
+                return
+            metrics.count('NodeRegistrationWaitTime', (time.time() - started) * 1000, 'Milliseconds')
+            try:
+                mutation.apply(k8s_api)
+            except:
+                if warm_pool:
+                    # a node in the warm pool must not become schedulable
+                    logger.exception('Unable to cordon node {} in the warm pool, abandoning ...'.format(hook_info['node_name']))
+                    raise
+                logger.exception('There was an error appending labels to the node {} '.format(hook_info['node_name']))
+                return
+            registered.append(True)
+            logger.info('Succeed in {} node {} on registration.'.format('cordoning and labeling' if warm_pool else 'labeling', hook_info['node_name']))
+
+        timeout = hook_info['launching_timeout']
+        if hook_info['continuation_enabled']:
+            # wait one interval at most, and leave the rest of the wait to later invocations
+            if continuation is None:
+                continuation = {'LaunchDeadline': time.time() + hook_info['launching_timeout']}
+            timeout = max(0, min(hook_info['continuation_interval'], continuation['LaunchDeadline'] - time.time()))
+
+        with metrics.timer('NodeReadyWaitTime'):
+            ready = node_ready(k8s_api, hook_info['node_name'], timeout, on_registered=on_registered)
+
+        if not ready and continuation is not None and time.time() < continuation['LaunchDeadline']:
+            if schedule_continuation(hook_info, continuation):
+                return LIFECYCLE_ACTION_RESCHEDULED
+            # like a drain which can't be continued, wait for the rest of the launch in this invocation
+            logger.warning('Waiting for node {} to be ready in this invocation'.format(hook_info['node_name']))
+            with metrics.timer('NodeReadyWaitTime'):
+                ready = node_ready(k8s_api, hook_info['node_name'], continuation['LaunchDeadline'] - time.time(), on_registered=on_registered)
+
+        if ready:
             continue_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
+            return LIFECYCLE_ACTION_CONTINUE
         else:
-            abandon_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])     
+            abandon_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
+            return LIFECYCLE_ACTION_ABANDON
 
 def terminate_node(k8s_api, hook_info):
-    
+
+    if hook_info['instance_lifecycle'] != 'Ec2Spot':
+        return remove_node(k8s_api, hook_info)
+
+    # a spot node may have been drained, or be draining, since its interruption warning
+    store = dedup_store()
+    drain_key = dedup.drain_key(hook_info['instance_id'])
+    if hook_info['continuation'] is not None:
+        result = remove_node(k8s_api, hook_info)
+        if result == LIFECYCLE_ACTION_CONTINUE:
+            finish_record(store, drain_key, result)
+        return result
+    record = claim_record(store, drain_key)
+    if record is not None:
+        timeout = claim_timeout()
+        if record['Status'] == dedup.IN_PROGRESS and timeout > 0:
+            record = store.wait(drain_key, timeout)
+        if record is not None and record['Status'] == dedup.COMPLETED:
+            logger.info('Node {} was already drained, with the outcome {}'.format(hook_info['node_name'], record.get('Outcome')))
+            metrics.count('SpotDrainsReused')
+            continue_lifecycle_action(aws_client('autoscaling'), hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
+            return LIFECYCLE_ACTION_CONTINUE
+        return remove_node(k8s_api, hook_info)
+
+    result = 'ERROR'
+    try:
+        result = remove_node(k8s_api, hook_info)
+        return result
+    finally:
+        # only a finished drain is recorded, so a later interruption warning can still drain a node
+        # whose drain was abandoned or continues in later invocations
+        finish_record(store, drain_key, result if result == LIFECYCLE_ACTION_CONTINUE else 'ERROR')
+
+def remove_node(k8s_api, hook_info):
+
+    asg = aws_client('autoscaling')
     try:
-        if not master_ready(k8s_api, asg, elb, ec2, hook_info['asg_name'], hook_info['node_name'], hook_info['node_role'], hook_info['launching_timeout']):
+        if hook_info['continuation'] is not None:
+            # the node was checked and cordoned by the invocation which started the drain
+            return drain_node(k8s_api, hook_info, hook_info['continuation']['Drain'])
+
+        # only a master node has to wait for the load balancer
+        elb, elbv2 = (aws_client('elb'), aws_client('elbv2')) if 'master' in hook_info['node_role'] else (None, None)
+        if not master_ready(k8s_api, asg, elb, aws_client('ec2'), hook_info['asg_name'], hook_info['node_name'], hook_info['node_role'], hook_info['launching_timeout'], elbv2):
             logger.error('There is no master node.')
             abandon_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
-            return
+            return LIFECYCLE_ACTION_ABANDON
 
         if not node_exists(k8s_api, hook_info['node_name']):
             logger.error('Node not found.')
             abandon_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
-            return
+            return LIFECYCLE_ACTION_ABANDON
 
-        cordon_node(k8s_api, hook_info['node_name'])
-        exclude_node_from_loadbalancer(k8s_api, hook_info['node_name'])
-        remove_all_pods(k8s_api, hook_info['node_name'])
+        NodeMutation(hook_info['node_name']).cordon().label(EXCLUDE_FROM_LOAD_BALANCERS_LABEL_KEY, 'asg-lifecycle-hook').apply(k8s_api)
+        if hook_info['continuation_enabled']:
+            return drain_node(k8s_api, hook_info, new_drain_state(hook_info['node_name']))
+        remove_all_pods(k8s_api, hook_info['node_name'], concurrency=hook_info['eviction_concurrency'], policy=hook_info['drain_policy'])
 
         continue_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
-            
+        return LIFECYCLE_ACTION_CONTINUE
+
     except:
         logger.exception('There was an error removing the pods from the node {}'.format(hook_info['node_name']))
         abandon_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
+        return LIFECYCLE_ACTION_ABANDON
+
+def drain_node(k8s_api, hook_info, state):
+
+    asg = aws_client('autoscaling')
+
+    with metrics.timer('DrainStepTime'):
+        state = drain_step(k8s_api, state, hook_info['eviction_concurrency'], hook_info['drain_policy'])
+
+    if state['Phase'] != DRAIN_PHASE_DONE:
+        if schedule_continuation(hook_info, dict(hook_info['continuation'] or {}, Drain=state)):
+            return LIFECYCLE_ACTION_RESCHEDULED
+        logger.warning('Finishing the drain of node {} in this invocation'.format(hook_info['node_name']))
+        remove_all_pods(k8s_api, hook_info['node_name'], concurrency=hook_info['eviction_concurrency'], policy=hook_info['drain_policy'])
+
+    continue_lifecycle_action(asg, hook_info['asg_name'], hook_info['name'], hook_info['instance_id'])
+    return LIFECYCLE_ACTION_CONTINUE
+
+def hook_deadline(hook_info):
+
+    # the lifecycle action times out after the heartbeat timeout, counted from the last heartbeat
+    if hook_info['transition'] == 'autoscaling:EC2_INSTANCE_LAUNCHING':
+        timeout = hook_info['launching_timeout']
+    else:
+        timeout = hook_info['terminating_timeout']
+    if hook_info['continuation'] is not None:
+        timeout -= hook_info['continuation_interval']
+    return retry.deadline(timeout - retry.SAFETY_MARGIN)
+
+def spot_event_deadline(event, context):
+
+    deadline = retry.invocation_deadline(context)
+    if event['detail-type'] != SPOT_INTERRUPTION_WARNING:
+        return deadline
+
+    # the instance is reclaimed two minutes after the warning was sent
+    sent = datetime.strptime(event['time'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+    reclaim = sent + SPOT_INTERRUPTION_NOTICE
+    return reclaim if deadline is None else min(deadline, reclaim)
+
+def drain_spot_node(k8s_api, env, node_name, transition):
+
+    if not node_exists(k8s_api, node_name):
+        return 'NOT_FOUND'
+
+    NodeMutation(node_name).cordon().label(EXCLUDE_FROM_LOAD_BALANCERS_LABEL_KEY, 'asg-lifecycle-hook').apply(k8s_api)
+
+    concurrency = max(env['eviction_concurrency'], SPOT_EVICTION_CONCURRENCY)
+    if transition == SPOT_INTERRUPTION_WARNING:
+        remove_all_pods(k8s_api, node_name, concurrency=concurrency, eviction_timeout=SPOT_EVICTION_TIMEOUT,
+                        termination_timeout=SPOT_TERMINATION_TIMEOUT, grace_period=SPOT_GRACE_PERIOD, prioritize=True,
+                        policy=env['drain_policy'])
+    else:
+        # a rebalance recommendation comes ahead of any interruption, so pods keep their grace periods
+        remove_all_pods(k8s_api, node_name, concurrency=concurrency, prioritize=True, policy=env['drain_policy'])
+    return 'DRAINED'
+
+def process_spot_event(event, context):
+
+    env = hook_env()
+    instance_id = event['detail']['instance-id']
+    outcome = {
+        'instance_id': instance_id,
+        'transition': event['detail-type']
+    }
+
+    # the events cover every spot instance of the account, so only act on the nodes of this group
+    instance = cache.describe_instance(aws_client('ec2'), instance_id)
+    asg_name = next((tag['Value'] for tag in instance.get('Tags') or [] if tag['Key'] == 'aws:autoscaling:groupName'), None)
+    if asg_name is None or asg_name != (env['autoscaling_group_name'] or asg_name) or 'master' in env['node_role']:
+        logger.info('Ignoring the %s event of instance %s, which is not a worker node of this auto scaling group' % (outcome['transition'], instance_id))
+        outcome['result'] = 'IGNORED'
+        return {'outcomes': [outcome]}
+
+    store = dedup_store()
+    drain_key = dedup.drain_key(instance_id)
+    with metrics.scope(metrics.hook_metrics(asg_name, outcome['transition'], instance_id)), metrics.timer('HookTime'), retry.scope(spot_event_deadline(event, context)):
+        if claim_record(store, drain_key) is not None:
+            logger.info('The node of instance %s is already drained or draining' % instance_id)
+            metrics.count('DuplicateRecords')
+            outcome['result'] = 'DUPLICATE'
+            return {'outcomes': [outcome]}
+
+        outcome['result'] = 'ERROR'
+        try:
+            # size the connection pool for the higher eviction concurrency
+            k8s_api = k8s_init(env, workers=-(-SPOT_EVICTION_CONCURRENCY // env['eviction_concurrency']))
+            outcome['result'] = drain_spot_node(k8s_api, env, instance['PrivateDnsName'], outcome['transition'])
+        except Exception as e:
+            logger.exception('There was an error draining the node of instance %s' % instance_id)
+            outcome['error'] = str(e)
+        finally:
+            finish_record(store, drain_key, outcome['result'])
+
+    logger.info('Spot event outcome: %s' % json.dumps(outcome))
+    if outcome['result'] == 'ERROR':
+        raise RuntimeError('Failed to drain the node of instance %s' % instance_id)
+    return {'outcomes': [outcome]}
+
+def process_hook(k8s_api, hook_info):
+
+    # execute specific action for lifecycle hook
+    with retry.scope(hook_deadline(hook_info)):
+        if hook_info['transition'] == 'autoscaling:EC2_INSTANCE_LAUNCHING':
+            return launch_node(k8s_api, hook_info)
+
+        elif hook_info['transition'] == 'autoscaling:EC2_INSTANCE_TERMINATING':
+            return terminate_node(k8s_api, hook_info)
+
+    return None
+
+def claim_timeout():
+
+    # how long a claim taken now may be held, which is until the deadline, or as long as any claim
+    # without one. An expired deadline leaves no time at all
+    remaining = retry.remaining()
+    return dedup.DEFAULT_CLAIM_TTL if remaining is None else remaining
+
+def claim_record(store, dedup_key):
+
+    # the claim expires once the invocation holding it has certainly ended
+    try:
+        return store.claim(dedup_key, claim_timeout() + retry.SAFETY_MARGIN)
+    except:
+        logger.exception('Unable to claim the lifecycle message %s, processing it anyway' % dedup_key)
+        return None
+
+def attach_record(store, dedup_key, record):
+
+    metrics.count('DuplicateRecords')
+    timeout = claim_timeout()
+    if record['Status'] == dedup.IN_PROGRESS and timeout > 0:
+        logger.info('The lifecycle message %s is already being processed, waiting for its outcome' % dedup_key)
+        record = store.wait(dedup_key, timeout)
+
+    if record is not None and record['Status'] == dedup.COMPLETED:
+        logger.info('The lifecycle message %s was already processed with the outcome %s' % (dedup_key, record.get('Outcome')))
+        return record.get('Outcome')
+    return 'DUPLICATE'
+
+def finish_record(store, dedup_key, result):
+
+    try:
+        if result == 'ERROR':
+            # let the retry of the invocation process the message again
+            store.release(dedup_key)
+        else:
+            store.complete(dedup_key, result, dedup.DEFAULT_TTL)
+    except:
+        logger.exception('Unable to record the outcome of the lifecycle message %s' % dedup_key)
+
+def process_record(k8s_api, hook_payload, deadline=None):
+
+    outcome = {
+        'instance_id': hook_payload.get('EC2InstanceId'),
+        'transition': hook_payload.get('LifecycleTransition')
+    }
+
+    hook_metrics = metrics.hook_metrics(hook_payload.get('AutoScalingGroupName'), outcome['transition'], outcome['instance_id'])
+    store = dedup_store()
+    dedup_key = dedup.key(hook_payload)
+    claimed = False
+
+    try:
+        with metrics.scope(hook_metrics), metrics.timer('HookTime'), retry.scope(deadline):
+            record = claim_record(store, dedup_key)
+            if record is not None:
+                outcome['result'] = attach_record(store, dedup_key, record)
+                outcome['duplicate'] = True
+            else:
+                claimed = True
+                k8s_api, hook_info = hook_init(hook_payload, k8s_api)
+                outcome['result'] = process_hook(k8s_api, hook_info)
+    except Exception as e:
+        logger.exception('There was an error processing the %s event of instance %s' % (outcome['transition'], outcome['instance_id']))
+        outcome['result'] = 'ERROR'
+        outcome['error'] = str(e)
+    finally:
+        if claimed:
+            finish_record(store, dedup_key, outcome['result'])
+
+    return outcome
 
 def lambda_handler(event, context):
 
     logger.info(event)
 
+    # spot interruption warnings and rebalance recommendations come straight from EventBridge
+    if event.get('detail-type') in (SPOT_INTERRUPTION_WARNING, REBALANCE_RECOMMENDATION):
+        return process_spot_event(event, context)
+
     # process asg lifecycle hooks
+    hook_payloads = []
     for record in event['Records']:
-        k8s_api_client = None
-        hook_info = {}
         hook_payload = json.loads(record['Sns']['Message'])
 
-        # initial variable from hook payload
+        # skip test notifications and other non lifecycle messages
         if 'LifecycleTransition' not in hook_payload:
             continue
-        else:
-            k8s_api_client, hook_info = hook_init(hook_payload)
+        hook_payloads.append(hook_payload)
 
-        # execute specific action for lifecycle hook
-        if hook_info['transition'] == 'autoscaling:EC2_INSTANCE_LAUNCHING':
-            launch_node(k8s_api_client, hook_info)
+    if not hook_payloads:
+        return {'outcomes': []}
 
-        elif hook_info['transition'] == 'autoscaling:EC2_INSTANCE_TERMINATING':
-            terminate_node(k8s_api_client, hook_info)
\ No newline at end of file
+    env = hook_env()
+    deadline = retry.invocation_deadline(context)
+    invocation_metrics = metrics.Metrics(['AutoScalingGroupName'], AutoScalingGroupName=hook_payloads[0]['AutoScalingGroupName'])
+
+    def init_k8s_api():
+        with metrics.scope(invocation_metrics):
+            metrics.count('Records', len(hook_payloads))
+            return k8s_init(env, workers=len(hook_payloads))
+
+    with ThreadPoolExecutor(max_workers=len(hook_payloads) + 1) as executor:
+        # share one kubernetes client across all records of this invocation, and build it while
+        # the records look up their instances
+        k8s_api_client = executor.submit(init_k8s_api)
+        outcomes = list(executor.map(lambda hook_payload: process_record(k8s_api_client, hook_payload, deadline), hook_payloads))
+
+    logger.info('Lifecycle hook outcomes: %s' % json.dumps(outcomes))
+
+    failed = [outcome['instance_id'] for outcome in outcomes if outcome['result'] == 'ERROR']
+    if failed:
+        # fail the invocation so that the failed records are retried, after all siblings have finished
+        raise RuntimeError('Failed to process lifecycle hooks of instances %s' % ', '.join(failed))
+
+    return {'outcomes': outcomes}
@@ -1,41 +1,321 @@
+import contextvars
+import json
 import logging
+import math
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from kubernetes import client, watch
 from kubernetes.client.rest import ApiException
 
+import cache
+import metrics
+import retry
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 MIRROR_POD_ANNOTATION_KEY = "kubernetes.io/config.mirror"
 CONTROLLER_KIND_DAEMON_SET = "DaemonSet"
+CONTROLLER_KIND_STATEFUL_SET = "StatefulSet"
+CONTROLLER_KIND_JOB = "Job"
+DEFAULT_EVICTION_CONCURRENCY = 10
+WATCH_TIMEOUT_SECONDS = 60  # Re-establish watch streams at least once a minute
+LIST_PAGE_SIZE = 250  # Bounds the memory used by a single page of a list
+EVICTION_TIMEOUT = 60  # Allow 1 minutes for pods to evict
+TERMINATION_TIMEOUT = 180  # Allow 3 minutes for pods to be terminated
+DRAIN_STEP_TIMEOUT = 15  # Bounds the eviction waves of one step of a continued drain
+
+EXCLUDE_FROM_LOAD_BALANCERS_LABEL_KEY = "node.kubernetes.io/exclude-from-external-load-balancers"
+OUT_OF_SERVICE_TAINT_KEY = "node.kubernetes.io/out-of-service"
+NODE_PATCH_TIMEOUT = 30  # Bounds the retries of a node patch on conflicts and transient errors
+
+DRAIN_PHASE_EVICTING = 'evicting'
+DRAIN_PHASE_TERMINATING = 'terminating'
+DRAIN_PHASE_DONE = 'done'
+
+DRAIN_ORDER_DEFAULT = 'default'
+DRAIN_ORDER_WORKLOAD = 'workload'
+
+
+class NodeMutation(object):
+    """Collects the labels, taints and unschedulable flag to set on a node and applies them all in a
+    single patch. Taints are merged with the taints the node already has, guarded by the node's
+    resourceVersion, because a patch replaces the whole list of taints.
+    """
 
-
-def cordon_node(api, node_name):
-    """Marks the specified node as unschedulable, which means that no new pods can be launched on the
-    node by the Kubernetes scheduler.
+    def __init__(self, node_name):
+        self.node_name = node_name
+        self.labels = {}
+        self.taints = []
+        self.unschedulable = None
+
+    def cordon(self):
+        self.unschedulable = True
+        return self
+
+    def label(self, key, value):
+        self.labels[key] = value
+        return self
+
+    def taint(self, key, value, effect):
+        self.taints.append({'key': key, 'value': value, 'effect': effect})
+        return self
+
+    def patch_body(self, node=None):
+        body = {'metadata': {}, 'spec': {}}
+        if self.labels:
+            body['metadata']['labels'] = dict(self.labels)
+        if self.unschedulable is not None:
+            body['spec']['unschedulable'] = self.unschedulable
+        if self.taints:
+            replaced = set((taint['key'], taint['effect']) for taint in self.taints)
+            body['spec']['taints'] = [taint for taint in node['spec'].get('taints') or []
+                                      if (taint['key'], taint.get('effect')) not in replaced] + self.taints
+            # the patch is rejected with a conflict if the taints changed since the node was read
+            body['metadata']['resourceVersion'] = node['metadata']['resourceVersion']
+        return body
+
+    def apply(self, api, timeout=NODE_PATCH_TIMEOUT, retryable=retry.is_retryable):
+        """Patches the node, retrying conflicts and the errors retryable classifies as transient for
+        up to timeout seconds.
+        """
+        def patch():
+            node = read_node_raw(api, self.node_name) if self.taints else None
+            # the patched node isn't needed, so skip building its client model
+            response = api.patch_node(self.node_name, self.patch_body(node), _preload_content=False)
+            metrics.count('KubernetesBytesReceived', len(response.data), 'Bytes')
+            response.release_conn()
+
+        def is_retryable(err):
+            return getattr(err, 'status', None) == 409 or retryable(err)
+
+        retry.call(patch, retry.deadline(timeout), retryable=is_retryable)
+
+
+class DrainPolicy(object):
+    """Decides the order the pods of a node are evicted in and which pods the drain waits for.
+
+    The default order evicts all pods at once. The workload order evicts the pods of Deployments
+    and other stateless workloads first, then the pods of StatefulSets one at a time, each once the
+    previous one is gone, and then the pods of Jobs, with job_grace_period shortening their grace
+    period. Without wait_for_jobs the drain is done once every pod but those of Jobs is gone, and
+    Jobs keep terminating until the instance does.
     """
-    patch_body = {
-        'apiVersion': 'v1',
-        'kind': 'Node',
-        'metadata': {
-            'name': node_name
-        },
-        'spec': {
-            'unschedulable': True
-        }
-    }
 
-    api.patch_node(node_name, patch_body)
+    def __init__(self, order=DRAIN_ORDER_DEFAULT, job_grace_period=None, wait_for_jobs=True):
+        if order not in (DRAIN_ORDER_DEFAULT, DRAIN_ORDER_WORKLOAD):
+            raise ValueError('Unknown drain order {}'.format(order))
+        self.order = order
+        self.job_grace_period = job_grace_period
+        self.wait_for_jobs = wait_for_jobs
+
+    def waits_for(self, pod):
+        return self.wait_for_jobs or controller_kind(pod) != CONTROLLER_KIND_JOB
+
+    def stages(self, pods, grace_period=None):
+        """Splits the pods into the stages they are evicted in, in order. Every stage is a tuple of
+        its pods, their grace period and whether the next stage waits until they are gone. The
+        grace period only caps every pod's own, see pod_grace_period.
+        """
+        if self.order != DRAIN_ORDER_WORKLOAD:
+            return [(pods, grace_period, False)] if pods else []
+
+        pods = sorted(pods, key=lambda pod: pod.spec.priority or 0, reverse=True)
+        stateful = [pod for pod in pods if controller_kind(pod) == CONTROLLER_KIND_STATEFUL_SET]
+        jobs = [pod for pod in pods if controller_kind(pod) == CONTROLLER_KIND_JOB]
+        stateless = [pod for pod in pods if controller_kind(pod) not in (CONTROLLER_KIND_STATEFUL_SET, CONTROLLER_KIND_JOB)]
+
+        job_grace_period = grace_period
+        if self.job_grace_period is not None:
+            job_grace_period = self.job_grace_period if grace_period is None else min(grace_period, self.job_grace_period)
+        stages = [(stateless, grace_period, False)] + [([pod], grace_period, True) for pod in stateful] + [(jobs, job_grace_period, False)]
+        return [stage for stage in stages if stage[0]]
+
+
+DEFAULT_DRAIN_POLICY = DrainPolicy()
+
+
+def controller_kind(pod):
+    for ref in pod.metadata.owner_references or []:
+        if ref.controller:
+            return ref.kind
+    return None
+
+
+def pod_key(pod):
+    return pod.metadata.namespace + "/" + pod.metadata.name
+
+
+def read_node_raw(api, node_name):
+    """Reads the node as raw JSON, skipping the generated client models."""
+    response = api.read_node(node_name, _preload_content=False)
+    data = response.data
+    response.release_conn()
+    metrics.count('KubernetesBytesReceived', len(data), 'Bytes')
+    return json.loads(data)
+
+
+def node_labels(node_role, instance_lifecycle):
+    return {
+        "lifecycle": instance_lifecycle,
+        "node-role.kubernetes.io/%s" % (node_role): ""
+    }
 
 
-def remove_all_pods(api, node_name, poll=5):
-    """Removes all Kubernetes pods from the specified node."""
+def remove_all_pods(api, node_name, poll=5, concurrency=DEFAULT_EVICTION_CONCURRENCY, eviction_timeout=EVICTION_TIMEOUT,
+                    termination_timeout=TERMINATION_TIMEOUT, grace_period=None, prioritize=False, policy=DEFAULT_DRAIN_POLICY):
+    """Removes all Kubernetes pods from the specified node. A grace_period overrides the termination
+    grace period of the evicted pods, prioritize evicts the pods with the highest priority first so
+    that they are the first to be rescheduled elsewhere, and policy orders the evictions by workload.
+    """
     pods = get_evictable_pods(api, node_name)
+    if prioritize:
+        pods.sort(key=lambda pod: pod.spec.priority or 0, reverse=True)
 
     logger.debug('Number of pods to delete: ' + str(len(pods)))
 
-    evict_until_completed(api, pods, poll)
-    wait_until_empty(api, node_name, poll)
+    with metrics.timer('EvictionTime'):
+        evict_in_stages(api, pods, policy, poll, concurrency, eviction_timeout, termination_timeout, grace_period)
+    with metrics.timer('WaitUntilEmptyTime'):
+        wait_until_empty(api, node_name, poll, concurrency, termination_timeout, policy.waits_for)
+
+
+def evict_in_stages(api, pods, policy, poll, concurrency=DEFAULT_EVICTION_CONCURRENCY, eviction_timeout=EVICTION_TIMEOUT,
+                    termination_timeout=TERMINATION_TIMEOUT, grace_period=None):
+    """Evicts the pods in the stages of the drain policy, waiting for the pods of a stage to be
+    gone before the next stage when the policy asks for it.
+    """
+    stages = policy.stages(pods, grace_period)
+    for index, (stage, stage_grace_period, wait) in enumerate(stages):
+        evict_until_completed(api, stage, poll, concurrency, eviction_timeout, stage_grace_period)
+        if wait and index < len(stages) - 1:
+            keys = set(pod_key(pod) for pod in stage)
+            for node_name in sorted(set(pod.spec.node_name for pod in stage)):
+                # a pod of a StatefulSet which doesn't terminate in time is left to the final wait
+                wait_until_empty(api, node_name, poll, concurrency, termination_timeout,
+                                 lambda pod: pod_key(pod) in keys, force=False)
+
+
+def new_drain_state(node_name):
+    """Returns the checkpoint of a drain which hasn't evicted anything yet."""
+    return {
+        'NodeName': node_name,
+        'Phase': DRAIN_PHASE_EVICTING,
+        'PendingPods': None,
+        'EvictionTime': 0,
+        'WaitingSince': None,
+        'TerminationDeadline': None,
+        'Steps': 0
+    }
+
+
+def drain_step(api, state, concurrency=DEFAULT_EVICTION_CONCURRENCY, policy=DEFAULT_DRAIN_POLICY, poll=5,
+               step_timeout=DRAIN_STEP_TIMEOUT):
+    """Advances the drain described by the checkpoint state, spending at most step_timeout seconds
+    on eviction waves and on waiting for the evicted pods, and returns the new checkpoint. The drain
+    is complete once its phase is DRAIN_PHASE_DONE. It goes through the same phases and stages as
+    remove_all_pods, but the caller decides when to take the next step. Every step evicts at most
+    one stage of the drain policy, and only the time its steps spend evicting counts towards the
+    eviction timeout of a stage, so the time between steps doesn't cut the waves short.
+    """
+    state = dict(state)
+    state['Steps'] = state.get('Steps', 0) + 1
+    node_name = state['NodeName']
+    now = time.time()
+    step_deadline = retry.deadline(step_timeout)
+
+    pods, resource_version = list_evictable_pods(api, node_name)
+    if len(pods) <= 0:
+        logger.info("All pods evicted successfully from node {}".format(node_name))
+        state['Phase'] = DRAIN_PHASE_DONE
+        state['PendingPods'] = []
+        return state
+
+    if state['Phase'] == DRAIN_PHASE_EVICTING:
+        # Only the pods which haven't been evicted yet need another eviction
+        pending_keys = state.get('PendingPods')
+        evicted = []
+        if pending_keys is not None:
+            pending_keys = set(pending_keys)
+            evicted = [pod for pod in pods if pod_key(pod) not in pending_keys]
+            pods = [pod for pod in pods if pod_key(pod) in pending_keys]
+
+        # the pods of StatefulSets go one at a time, so the next stage waits until the evicted one is gone
+        terminating = policy.order == DRAIN_ORDER_WORKLOAD and any(controller_kind(pod) == CONTROLLER_KIND_STATEFUL_SET for pod in evicted)
+        state['WaitingSince'] = (state.get('WaitingSince') or now) if terminating else None
+        if not pods:
+            pending = []
+        elif terminating and now - state['WaitingSince'] < TERMINATION_TIMEOUT:
+            logger.info("Waiting for termination of pods {} before the next eviction".format(", ".join(map(pod_key, evicted))))
+            pending = pods
+        else:
+            stages = policy.stages(pods)
+            stage, stage_grace_period, _ = stages[0]
+            eviction_time = state.get('EvictionTime', 0)
+            stage_pending = evict_in_waves(api, stage, poll, min(step_deadline, retry.deadline(EVICTION_TIMEOUT - eviction_time)),
+                                           concurrency, stage_grace_period)
+            eviction_time += time.time() - now
+            if stage_pending and eviction_time >= EVICTION_TIMEOUT:
+                logger.error(
+                    "Timeout waiting for pods to evict, deleting remaining pods...")
+                delete_pods(api, stage_pending, force=False, concurrency=concurrency, grace_period=stage_grace_period)
+                stage_pending = []
+            # every stage has an eviction timeout of its own
+            state['EvictionTime'] = eviction_time if stage_pending else 0
+            pending = stage_pending + [pod for later, _, _ in stages[1:] for pod in later]
+
+        state['PendingPods'] = [pod.metadata.namespace + "/" + pod.metadata.name for pod in pending]
+        if pending:
+            return state
+        state['Phase'] = DRAIN_PHASE_TERMINATING
+        state['TerminationDeadline'] = now + TERMINATION_TIMEOUT
+        # the pods were evicted since the list, so the wait lists them again
+        resource_version = None
+
+    # wait for the evicted pods for the rest of the step, so that a drain whose pods go away
+    # quickly is done in this invocation rather than the next one
+    until = min(step_deadline, state['TerminationDeadline'])
+    listed = [(pods, resource_version)] if resource_version is not None else []
+
+    def check_terminated():
+        pods, resource_version = listed.pop() if listed else list_evictable_pods(api, node_name)
+        pods = [pod for pod in pods if policy.waits_for(pod)]
+        if len(pods) <= 0 or time.time() >= until:
+            return pods, None
+        return None, lambda: wait_until_deleted(api, node_name, pods, resource_version, until)
+
+    pods = list_and_watch(check_terminated, until, poll, "pods on node {}".format(node_name))
+    if len(pods) <= 0:
+        logger.info("All pods the drain waits for are gone from node {}".format(node_name))
+        state['Phase'] = DRAIN_PHASE_DONE
+        state['PendingPods'] = []
+        return state
+
+    state['PendingPods'] = [pod.metadata.namespace + "/" + pod.metadata.name for pod in pods]
+    if time.time() > state['TerminationDeadline']:
+        logger.error(
+            "Timeout waiting for pods to be terminated, force deleting remaining pods")
+        delete_pods(api, pods, force=True, concurrency=concurrency)
+        taint_non_graceful_shutdown(api, node_name)
+        state['Phase'] = DRAIN_PHASE_DONE
+    else:
+        logger.info("Waiting for termination of pods {} on node {}".format(", ".join(state['PendingPods']), node_name))
+    return state
+
+
+def run_concurrently(func, items, concurrency):
+    """Applies func to every item with at most `concurrency` requests in flight and returns
+    the results in the same order as the items.
+    """
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    # run every item in a copy of the caller's context so that metrics are attributed to its hook
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(items))) as executor:
+        return list(executor.map(lambda item: context.copy().run(func, item), items))
 
 
 def pod_is_evictable(pod):
@@ -55,112 +335,396 @@ def pod_is_evictable(pod):
 
 
 def get_evictable_pods(api, node_name):
+    return list_evictable_pods(api, node_name)[0]
+
+
+def list_evictable_pods(api, node_name):
+    """Returns the evictable pods on the node together with the resourceVersion of the list,
+    which a watch can resume from.
+    """
     field_selector = 'spec.nodeName=' + node_name
-    pods = api.list_pod_for_all_namespaces(
-        watch=False, field_selector=field_selector)
-    return [pod for pod in pods.items if pod_is_evictable(pod)]
+    pods, resource_version = list_lean(api.list_pod_for_all_namespaces, lean_pod, field_selector=field_selector)
+    return [pod for pod in pods if pod_is_evictable(pod)], resource_version
 
 
-def evict_until_completed(api, pods, poll):
-    timeout = time.time() + 60  # Allow 1 minutes for pods to evict
-    pending = pods
+def list_lean(func, extract, **kwargs):
+    """Lists objects page by page as raw JSON, skipping the generated client models, and keeps
+    only what extract takes from each item. Returns the extracted items together with the
+    resourceVersion of the list.
+    """
+    items = []
+    resource_version = None
+    continue_token = None
     while True:
-        pending = evict_pods(api, pending)
-        if (len(pending)) <= 0:
-            return
-        elif time.time() > timeout:
-            logger.error(
-                "Timeout waiting for pods to evict, deleting remaining pods...")
-            delete_pods(api, pending, force=False)
-            return
-        time.sleep(poll)
+        if continue_token:
+            kwargs['_continue'] = continue_token
+        try:
+            response = func(limit=LIST_PAGE_SIZE, _preload_content=False, **kwargs)
+        except ApiException as err:
+            if err.status == 410 and continue_token:
+                # The continue token expired, restart the list from the beginning
+                items = []
+                continue_token = None
+                kwargs.pop('_continue', None)
+                continue
+            raise
+        data = response.data
+        response.release_conn()
+        metrics.count('KubernetesBytesReceived', len(data), 'Bytes')
+        page = json.loads(data)
+        del data
+
+        items.extend(extract(item) for item in page.get('items') or [])
+        resource_version = page['metadata'].get('resourceVersion')
+        continue_token = page['metadata'].get('continue')
+        if not continue_token:
+            return items, resource_version
+
+
+def lean_pod(item):
+    """Extracts the fields the eviction logic needs from a raw pod, in the attribute layout of
+    the client models.
+    """
+    metadata = item['metadata']
+    owner_references = None
+    if metadata.get('ownerReferences') is not None:
+        owner_references = [SimpleNamespace(kind=ref.get('kind'), controller=ref.get('controller'))
+                            for ref in metadata['ownerReferences']]
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            namespace=metadata.get('namespace'),
+            name=metadata.get('name'),
+            labels=metadata.get('labels'),
+            annotations=metadata.get('annotations'),
+            owner_references=owner_references
+        ),
+        spec=SimpleNamespace(node_name=item.get('spec', {}).get('nodeName'), priority=item.get('spec', {}).get('priority'),
+                             termination_grace_period_seconds=item.get('spec', {}).get('terminationGracePeriodSeconds'))
+    )
+
+
+def lean_node(item):
+    """Extracts the name and conditions from a raw node, in the attribute layout of the client models."""
+    return SimpleNamespace(
+        metadata=SimpleNamespace(name=item['metadata'].get('name')),
+        status=SimpleNamespace(conditions=[SimpleNamespace(type=condition.get('type'), status=condition.get('status'))
+                                           for condition in item.get('status', {}).get('conditions') or []])
+    )
+
+
+def watch_events(func, resource_version, deadline, **kwargs):
+    """Streams watch events of the list function starting from resource_version until the deadline.
+    The stream ends early when the server closes it, so callers should re-list and watch again.
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        return
+    # round up, or the last second before the deadline would be spent re-listing without a watch
+    timeout_seconds = int(math.ceil(min(WATCH_TIMEOUT_SECONDS, remaining)))
+
+    w = watch.Watch()
+    try:
+        for event in w.stream(func, resource_version=resource_version, timeout_seconds=timeout_seconds,
+                              _request_timeout=timeout_seconds + 5, **kwargs):
+            yield event
+    finally:
+        w.stop()
+
+
+def list_and_watch(step, until, poll, description):
+    """Calls step until it returns a result, and in between waits on the watch step returns along
+    with its result, or polls with backoff when it returns no watch. Every call of step lists
+    afresh, so a watch which ends, or whose resourceVersion is too old, resumes from a new list. A
+    watch which fails otherwise falls back to polling for good, and a watch which returns anything
+    but None ends the wait with it. Transient errors of step are retried with backoff until until.
+    """
+    use_watch = True
+    attempt = 0
+    while True:
+        result, watch_next = retry.call(step, until, cap=poll)
+        if result is not None:
+            return result
+        if use_watch and watch_next is not None:
+            try:
+                result = watch_next()
+                if result is not None:
+                    return result
+                continue
+            except ApiException as err:
+                if err.status == 410:
+                    # The resourceVersion is too old, re-list and resume from a fresh one
+                    continue
+                logger.warning("Unable to watch {} due to \"{}\", falling back to polling".format(description, err.reason))
+                use_watch = False
+            except:
+                logger.exception("Unable to watch {}, falling back to polling".format(description))
+                use_watch = False
+        retry.sleep(retry.backoff(attempt, cap=poll), until)
+        attempt += 1
+
+
+def evict_until_completed(api, pods, poll, concurrency=DEFAULT_EVICTION_CONCURRENCY, timeout=EVICTION_TIMEOUT,
+                          grace_period=None):
+    """Evicts the pods in waves, and deletes the pods still pending eviction after the timeout."""
+    pending = evict_in_waves(api, pods, poll, retry.deadline(timeout), concurrency, grace_period)
+    if pending:
+        logger.error(
+            "Timeout waiting for pods to evict, deleting remaining pods...")
+        delete_pods(api, pending, force=False, concurrency=concurrency, grace_period=grace_period)
+
+
+def evict_in_waves(api, pods, poll, until, concurrency=DEFAULT_EVICTION_CONCURRENCY, grace_period=None):
+    """Evicts the pods in waves sized to the disruptions their PodDisruptionBudgets allow, so that
+    evictions which are sure to be rejected are not sent. The next wave starts as soon as a budget
+    allows more disruptions again, i.e. when replacement pods become ready. Returns the pods still
+    pending eviction once until has passed.
+    """
+    pending = pods
+    policy_api = client.PolicyV1Api(api.api_client)
+    use_budgets = True
+
+    def evict_wave():
+        nonlocal pending, use_budgets
+        budgets, resource_version = [], None
+        if use_budgets:
+            try:
+                budgets, resource_version = list_disruption_budgets(policy_api, pending)
+            except:
+                logger.exception("Unable to list pod disruption budgets, evicting without planning waves")
+                use_budgets = False
+
+        wave, deferred, deferred_keys = plan_eviction_wave(pending, budgets)
+        pending = evict_pods(api, wave, concurrency, grace_period) + deferred
+        if (len(pending)) <= 0 or time.time() > until:
+            return pending, None
+        logger.info("Pods still pending eviction: {}".format(
+            ", ".join(map(lambda pod: pod.metadata.namespace + "/" + pod.metadata.name, pending))))
+
+        # evictions rejected for other reasons than the budgets are retried with backoff
+        if not deferred:
+            return None, None
+        return None, lambda: wait_for_disruptions_allowed(policy_api, deferred_keys, resource_version, until) and None
+
+    return list_and_watch(evict_wave, until, poll, "pod disruption budgets")
+
+
+def list_disruption_budgets(policy_api, pods):
+    """Returns the PodDisruptionBudgets in the namespaces of the pods together with the
+    resourceVersion of the list.
+    """
+    namespaces = set(pod.metadata.namespace for pod in pods)
+    budgets = policy_api.list_pod_disruption_budget_for_all_namespaces(watch=False)
+    return [budget for budget in budgets.items if budget.metadata.namespace in namespaces], budgets.metadata.resource_version
+
+
+def selector_matches(selector, labels):
+    """Determines whether the label selector matches the labels. A null selector matches nothing
+    and an empty selector matches everything.
+    """
+    if selector is None:
+        return False
+    labels = labels or {}
+    for key, value in (selector.match_labels or {}).items():
+        if labels.get(key) != value:
+            return False
+    for expression in selector.match_expressions or []:
+        values = expression.values or []
+        if expression.operator == 'In' and labels.get(expression.key) not in values:
+            return False
+        elif expression.operator == 'NotIn' and expression.key in labels and labels[expression.key] in values:
+            return False
+        elif expression.operator == 'Exists' and expression.key not in labels:
+            return False
+        elif expression.operator == 'DoesNotExist' and expression.key in labels:
+            return False
+    return True
 
 
-def evict_pods(api, pods):
-    remaining = []
+def plan_eviction_wave(pods, budgets):
+    """Splits the pods into the wave which their budgets currently allow to be evicted and the
+    pods which have to wait for a later wave, and returns the keys of the budgets which hold those
+    pods back as well.
+    """
+    allowed = dict((budget.metadata.namespace + "/" + budget.metadata.name,
+                    (budget.status.disruptions_allowed or 0) if budget.status else 0) for budget in budgets)
+    wave = []
+    deferred = []
+    deferred_keys = set()
     for pod in pods:
-        logger.info('Evicting pod {} in namespace {}'.format(
-            pod.metadata.name, pod.metadata.namespace))
-        body = {
-            'apiVersion': 'policy/v1beta1',
-            'kind': 'Eviction',
-            'deleteOptions': {},
-            'metadata': {
-                'name': pod.metadata.name,
-                'namespace': pod.metadata.namespace
-            }
+        keys = [budget.metadata.namespace + "/" + budget.metadata.name for budget in budgets
+                if budget.metadata.namespace == pod.metadata.namespace and selector_matches(budget.spec.selector, pod.metadata.labels)]
+        if all(allowed[key] > 0 for key in keys):
+            for key in keys:
+                allowed[key] -= 1
+            wave.append(pod)
+        else:
+            deferred.append(pod)
+            deferred_keys.update(keys)
+
+    if deferred:
+        logger.info("Deferring eviction of {} pods until their disruption budgets allow it".format(len(deferred)))
+    # a budget which still allows disruptions once the wave is evicted doesn't hold any pod back
+    return wave, deferred, set(key for key in deferred_keys if allowed[key] <= 0)
+
+
+def wait_for_disruptions_allowed(policy_api, keys, resource_version, deadline):
+    """Watches the PodDisruptionBudgets and returns True as soon as one of the budgets with the
+    given keys allows a disruption, or False when the watch stream ends first.
+    """
+    for event in watch_events(policy_api.list_pod_disruption_budget_for_all_namespaces, resource_version, deadline):
+        budget = event['object']
+        if budget.metadata.namespace + "/" + budget.metadata.name not in keys:
+            continue
+        if event['type'] == 'DELETED' or (budget.status and (budget.status.disruptions_allowed or 0) > 0):
+            return True
+    return False
+
+
+def pod_grace_period(pod, grace_period):
+    """Returns the grace period to request for the pod, which only ever shortens its own
+    terminationGracePeriodSeconds. The API server takes a longer one as well.
+    """
+    own = pod.spec.termination_grace_period_seconds
+    if grace_period is None or own is None:
+        return grace_period
+    return min(grace_period, own)
+
+
+def evict_pod(api, pod, grace_period=None):
+    """Evicts a single pod and returns True when the eviction was rejected by a disruption
+    budget or failed with a transient error, and should be retried.
+    """
+    logger.info('Evicting pod {} in namespace {}'.format(
+        pod.metadata.name, pod.metadata.namespace))
+    grace_period = pod_grace_period(pod, grace_period)
+    body = {
+        'apiVersion': 'policy/v1beta1',
+        'kind': 'Eviction',
+        'deleteOptions': {} if grace_period is None else {'gracePeriodSeconds': grace_period},
+        'metadata': {
+            'name': pod.metadata.name,
+            'namespace': pod.metadata.namespace
         }
-        try:
-            api.create_namespaced_pod_eviction(
-                pod.metadata.name, pod.metadata.namespace, body)
-        except ApiException as err:
-            if err.status == 429:
-                remaining.append(pod)
-                logger.warning("Failed to evict pod {}/{} due to disruption budget. Will retry.".format(
-                    pod.metadata.namespace, pod.metadata.name))
-            else:
-                logger.exception("Unable to evict pod {}/{} due to \"{}\"".format(
-                    pod.metadata.namespace, pod.metadata.name, err.reason))
-        except:
-            logger.exception("Unexpected error adding eviction for pod {}/{}, \"{}\"".format(
+    }
+    try:
+        api.create_namespaced_pod_eviction(
+            pod.metadata.name, pod.metadata.namespace, body)
+        metrics.count('PodsEvicted')
+    except ApiException as err:
+        if err.status == 429:
+            metrics.count('EvictionRetries')
+            logger.warning("Failed to evict pod {}/{} due to disruption budget. Will retry.".format(
+                pod.metadata.namespace, pod.metadata.name))
+            return True
+        elif err.status == 404:
+            logger.info("Pod {}/{} was not found. It may have been deleted by another process.".format(
+                pod.metadata.namespace, pod.metadata.name))
+        elif retry.is_retryable(err):
+            metrics.count('EvictionRetries')
+            logger.warning("Failed to evict pod {}/{} due to \"{}\". Will retry.".format(
+                pod.metadata.namespace, pod.metadata.name, err.reason))
+            return True
+        else:
+            logger.exception("Unable to evict pod {}/{} due to \"{}\"".format(
+                pod.metadata.namespace, pod.metadata.name, err.reason))
+    except Exception as err:
+        if retry.is_retryable(err):
+            metrics.count('EvictionRetries')
+            logger.warning("Failed to evict pod {}/{} due to \"{}\". Will retry.".format(
                 pod.metadata.namespace, pod.metadata.name, err))
-    return remaining
+            return True
+        logger.exception("Unexpected error adding eviction for pod {}/{}, \"{}\"".format(
+            pod.metadata.namespace, pod.metadata.name, err))
+    return False
+
+
+def evict_pods(api, pods, concurrency=DEFAULT_EVICTION_CONCURRENCY, grace_period=None):
+    """Evicts the pods concurrently and returns the pods which are still pending eviction."""
+    results = run_concurrently(lambda pod: evict_pod(api, pod, grace_period), pods, concurrency)
+    return [pod for pod, pending in zip(pods, results) if pending]
 
 
-def delete_pods(api, pods, force=False):
+def delete_pod(api, pod, force=False, grace_period=None):
     msg_prefix = "Force deleting" if force else "Deleting"
-    for pod in pods:
-        logger.info("{} pod {}/{}".format(
-            msg_prefix, pod.metadata.namespace, pod.metadata.name))
-        try:
-            body = {'gracePeriodSeconds': 0} if force else {}
-            api.delete_namespaced_pod(
-                pod.metadata.name, pod.metadata.namespace, body=body)
-            logger.info(
-                "Pod {}/{} deleted successfully".format(pod.metadata.namespace, pod.metadata.name))
-        except ApiException as err:
-            if err.status == 404:
-                logger.warning("Pod {}/{} was not found. It may have been deleted by another process.".format(
-                    pod.metadata.namespace, pod.metadata.name))
-        except:
-            logger.exception(
-                "Unexpected error deleting pod {}/{}".format(pod.metadata.namespace, pod.metadata.name))
+    logger.info("{} pod {}/{}".format(
+        msg_prefix, pod.metadata.namespace, pod.metadata.name))
+    try:
+        grace_period = 0 if force else pod_grace_period(pod, grace_period)
+        body = {} if grace_period is None else {'gracePeriodSeconds': grace_period}
+        api.delete_namespaced_pod(
+            pod.metadata.name, pod.metadata.namespace, body=body)
+        metrics.count('PodsForceDeleted' if force else 'PodsDeleted')
+        logger.info(
+            "Pod {}/{} deleted successfully".format(pod.metadata.namespace, pod.metadata.name))
+    except ApiException as err:
+        if err.status == 404:
+            logger.warning("Pod {}/{} was not found. It may have been deleted by another process.".format(
+                pod.metadata.namespace, pod.metadata.name))
+        else:
+            logger.exception("Unable to delete pod {}/{} due to \"{}\"".format(
+                pod.metadata.namespace, pod.metadata.name, err.reason))
+    except:
+        logger.exception(
+            "Unexpected error deleting pod {}/{}".format(pod.metadata.namespace, pod.metadata.name))
+
 
+def delete_pods(api, pods, force=False, concurrency=DEFAULT_EVICTION_CONCURRENCY, grace_period=None):
+    run_concurrently(lambda pod: delete_pod(api, pod, force, grace_period), pods, concurrency)
 
-def wait_until_empty(api, node_name, poll):
+
+def wait_until_empty(api, node_name, poll, concurrency=DEFAULT_EVICTION_CONCURRENCY, timeout=TERMINATION_TIMEOUT,
+                     wait_for=None, force=True):
+    """Waits until the evictable pods on the node are gone, or only those which wait_for rejects.
+    The pods still there after the timeout are force deleted, unless force is False.
+    """
     logger.info("Waiting for evictions to complete")
-    timeout = time.time() + 180  # Allow 3 minutes for pods to be terminated
-    while True:
-        pods = get_evictable_pods(api, node_name)
+    timeout = retry.deadline(timeout)
+
+    def check_empty():
+        pods, resource_version = list_evictable_pods(api, node_name)
+        if wait_for is not None:
+            pods = [pod for pod in pods if wait_for(pod)]
         if len(pods) <= 0:
             logger.info("All pods evicted successfully")
-            return
+            return True, None
         logger.info("Waiting for pod termination...")
         logger.debug("Still waiting for deletion of the following pods: {}".format(
             ", ".join(map(lambda pod: pod.metadata.namespace + "/" + pod.metadata.name, pods))))
-        if time.time() > timeout:
+        if time.time() > timeout and not force:
+            logger.warning("Timeout waiting for pods {} to be terminated".format(", ".join(map(pod_key, pods))))
+            return True, None
+        elif time.time() > timeout:
             logger.error(
                 "Timeout waiting for pods to be terminated, force deleting remaining pods")
-            delete_pods(api, pods, force=True)
+            delete_pods(api, pods, force=True, concurrency=concurrency)
             taint_non_graceful_shutdown(api, node_name)
+            return True, None
+        return None, lambda: wait_until_deleted(api, node_name, pods, resource_version, timeout)
+
+    list_and_watch(check_empty, timeout, poll, "pods on node {}".format(node_name))
+
+
+def wait_until_deleted(api, node_name, pods, resource_version, deadline):
+    """Watches the pods on the node and returns once all the given pods have been deleted, or when
+    the watch stream ends.
+    """
+    remaining = set(pod.metadata.namespace + "/" + pod.metadata.name for pod in pods)
+    field_selector = 'spec.nodeName=' + node_name
+    for event in watch_events(api.list_pod_for_all_namespaces, resource_version, deadline,
+                              field_selector=field_selector):
+        if event['type'] != 'DELETED':
+            continue
+        pod = event['object']
+        remaining.discard(pod.metadata.namespace + "/" + pod.metadata.name)
+        if not remaining:
             return
-        time.sleep(poll)
 
 
 def taint_non_graceful_shutdown(api, node_name):
     """Taints the specified node with the non-graceful shutdown taint, which indicates that the node"""
     # Ref: https://kubernetes.io/blog/2022/12/16/kubernetes-1-26-non-graceful-node-shutdown-beta/
-    patch_body = {
-        "spec": {
-            "taints": [{
-                "effect": "NoSchedule",
-                "key": "node.kubernetes.io/out-of-service",
-                "value": "nodeshutdown"
-            }]
-        }
-    }
     try:
-        api.patch_node(node_name, patch_body)
+        NodeMutation(node_name).taint(OUT_OF_SERVICE_TAINT_KEY, "nodeshutdown", "NoSchedule").apply(api)
         logger.info(
             "Node {} has been tainted with the non-graceful shutdown taint".format(node_name))
     except:
@@ -168,16 +732,15 @@ def taint_non_graceful_shutdown(api, node_name):
             "There was an error tainting the node {} with the non-graceful shutdown taint".format(node_name))
 
 
-def master_ready(api, asg_client, lb_client, ec2_client, asg_name, node_name, node_role, timeout):
+def master_ready(api, asg_client, lb_client, ec2_client, asg_name, node_name, node_role, timeout, lbv2_client=None,
+                 min_poll=1, max_poll=10):
     """Determines whether the K8s master node are ready"""
 
     # The asg instance refresh operaiton is not for master role
     if 'master' not in node_role:
         return True
 
-    asg_info = asg_client.describe_auto_scaling_groups(
-        AutoScalingGroupNames=[asg_name]
-    )['AutoScalingGroups'][0]
+    asg_info = cache.describe_auto_scaling_group(asg_client, asg_name)
     asg_instances = asg_info['Instances']
     asg_desired_capacity = asg_info['DesiredCapacity']
     asg_remain_instances = [instance['InstanceId']
@@ -188,89 +751,141 @@ def master_ready(api, asg_client, lb_client, ec2_client, asg_name, node_name, no
         return True
 
     # There is only one node in the master asg, waiting for the node bind to lb
-    waiting_timeout = time.time() + timeout
+    lb_names = asg_info.get('LoadBalancerNames') or []
+    target_group_arns = asg_info.get('TargetGroupARNs') or []
+    if not lb_names and not target_group_arns:
+        logger.error('The master auto scaling group {} has neither load balancers nor target groups to wait for'.format(asg_name))
+        return False
 
-    lb_name = asg_client.describe_load_balancers(AutoScalingGroupName=asg_name)[
-        'LoadBalancers'][0]['LoadBalancerName']
+    waiting_timeout = retry.deadline(timeout)
+    attempt = 0
 
     while True:
         if time.time() > waiting_timeout:
-            logger.exception(
+            logger.error(
                 'timeout waiting for master node {} ready'.format(node_name))
             return False
 
         try:
-            lb_instances = lb_client.describe_load_balancers(LoadBalancerNames=[lb_name])[
-                'LoadBalancerDescriptions'][0]['Instances']
-
-            for target_instance in lb_instances:
-                if target_instance['InstanceId'] in asg_remain_instances:
-
-                    target_instance_state = lb_client.describe_instance_health(
-                        LoadBalancerName=lb_name,
-                        Instances=[
-                            {
-                                'InstanceId': target_instance['InstanceId']
-                            },
-                        ]
-                    )['InstanceStates'][0]['State']
-
-                    if target_instance_state == 'InService':
-                        master_instance = ec2_client.describe_instances(
-                            InstanceIds=[target_instance['InstanceId']])['Reservations'][0]['Instances'][0]
-                        node_name = master_instance['PrivateDnsName']
-                        instance_lifecycle = 'Ec2Spot' if 'InstanceLifecycle' in master_instance else 'OnDemand'
-                        append_node_labels(
-                            api, node_name, node_role, instance_lifecycle)
-
-                        return True
-
-            time.sleep(10)
-
-        except:
-            logger.exception(
-                'There was an error waiting the node {} ready'.format(node_name))
-            return False
+            # One batched health query per load balancer and target group covers all remaining instances
+            healthy_instance = find_healthy_instance(
+                lb_client, lbv2_client, ec2_client, lb_names, target_group_arns, asg_remain_instances)
 
+            if healthy_instance is not None:
+                master_instance = cache.describe_instance(ec2_client, healthy_instance)
+                node_name = master_instance['PrivateDnsName']
+                instance_lifecycle = 'Ec2Spot' if 'InstanceLifecycle' in master_instance else 'OnDemand'
+                append_node_labels(
+                    api, node_name, node_role, instance_lifecycle)
 
-def node_ready(api, node_name, timeout):
-    """Determines whether the specified node is ready."""
+                return True
 
-    waiting_timeout = time.time() + timeout
+        except Exception as e:
+            if not retry.is_retryable(e):
+                logger.exception(
+                    'There was an error waiting the node {} ready'.format(node_name))
+                return False
+            logger.warning('Transient error waiting the node {} ready: {}'.format(node_name, e))
+
+        # Back off while the new master is still booting, but notice it soon once it registers
+        retry.sleep(retry.backoff(attempt, min_poll, max_poll), waiting_timeout)
+        attempt += 1
+
+
+def find_healthy_instance(lb_client, lbv2_client, ec2_client, lb_names, target_group_arns, instance_ids):
+    """Returns one of the instances which is in service behind a classic load balancer or healthy in
+    a target group, or None. Each load balancer and target group costs a single call.
+    """
+    for lb_name in lb_names:
+        # Without Instances, the health of every registered instance is returned in one call
+        for state in lb_client.describe_instance_health(LoadBalancerName=lb_name)['InstanceStates']:
+            if state['InstanceId'] in instance_ids and state['State'] == 'InService':
+                return state['InstanceId']
+
+    if target_group_arns:
+        targets = None
+        for target_group_arn in target_group_arns:
+            for description in lbv2_client.describe_target_health(TargetGroupArn=target_group_arn)['TargetHealthDescriptions']:
+                if description['TargetHealth']['State'] != 'healthy':
+                    continue
+                target_id = description['Target']['Id']
+                if target_id in instance_ids:
+                    return target_id
+                # Target groups of the ip target type are keyed by the private ip address
+                if targets is None:
+                    targets = dict((cache.describe_instance(ec2_client, instance_id).get('PrivateIpAddress'), instance_id)
+                                   for instance_id in instance_ids)
+                if target_id in targets:
+                    return targets[target_id]
+
+    return None
+
+
+def node_ready(api, node_name, timeout, poll=10, on_registered=None):
+    """Determines whether the specified node is ready. on_registered is called once as soon as the
+    node is registered, before it is reported ready, and the node isn't ready while it fails.
+    """
+
+    waiting_timeout = retry.deadline(timeout)
     field_selector = 'metadata.name=' + node_name
+    registered = on_registered is None
 
-    while True:
+    def check_ready():
+        nonlocal registered
         if time.time() > waiting_timeout:
-            logger.exception(
+            logger.error(
                 'timeout waiting for node {} launch'.format(node_name))
-            return False
+            return False, None
 
         try:
-            nodes = api.list_node(
-                pretty=True, field_selector=field_selector, _request_timeout=15).items
+            nodes, resource_version = list_lean(
+                api.list_node, lean_node, field_selector=field_selector, _request_timeout=15)
+
+            if nodes and not registered:
+                on_registered()
+                registered = True
 
             if not nodes:
                 # Node doesn't exist yet - equivalent to node_exists() returning False
                 logger.info(
                     'Node {} is not registered to K8s, waiting for it to be registered'.format(node_name))
-                time.sleep(10)
-                continue
+            elif is_node_ready(nodes[0]):
+                return True, None
+            else:
+                logger.info(
+                    'Node {} is not ready, waiting for it to be ready'.format(node_name))
+        except Exception as e:
+            if not retry.is_retryable(e):
+                logger.exception(
+                    'There was an error waiting for node {} ready'.format(node_name))
+                return False, None
+            logger.warning('Transient error waiting for node {} ready: {}'.format(node_name, e))
+            return None, None
 
-            # Node exists - get the first (and only) result
-            node = nodes[0]
+        # a node which shows up before it was registered is listed again, and patched, before it is ready
+        return None, lambda: True if watch_node_ready(api, field_selector, resource_version, waiting_timeout, not registered) and registered else None
 
-            # Check if node is ready
-            for condition in node.status.conditions:
-                if condition.type == 'Ready' and condition.status == 'True':
-                    return True
+    return list_and_watch(check_ready, waiting_timeout, poll, 'node {}'.format(node_name))
 
-            logger.info(
-                'Node {} is not ready, waiting for it to be ready'.format(node_name))
-            time.sleep(10)
-        except Exception as e:
-            logger.exception(
-                'There was an error waiting for node {} ready'.format(node_name))
-            return False
+
+def is_node_ready(node):
+    """Determines whether the node reports the Ready condition."""
+    if node.status is None:
+        return False
+    for condition in node.status.conditions or []:
+        if condition.type == 'Ready' and condition.status == 'True':
+            return True
+    return False
+
+
+def watch_node_ready(api, field_selector, resource_version, deadline, until_registered=False):
+    """Watches the node and returns True as soon as it becomes ready, or as soon as it shows up
+    with until_registered, or False when the watch stream ends first.
+    """
+    for event in watch_events(api.list_node, resource_version, deadline, field_selector=field_selector):
+        if event['type'] in ('ADDED', 'MODIFIED') and (until_registered or is_node_ready(event['object'])):
+            return True
+    return False
 
 
 def node_exists(api, node_name):
@@ -279,8 +894,8 @@ def node_exists(api, node_name):
     try:
         # Use field_selector instead of listing all nodes
         field_selector = 'metadata.name=' + node_name
-        nodes = api.list_node(
-            pretty=True, field_selector=field_selector, _request_timeout=10).items
+        nodes, _ = list_lean(
+            api.list_node, lean_node, field_selector=field_selector, _request_timeout=10)
 
         if nodes:
             logger.info('Node {} exists in the cluster'.format(node_name))
@@ -296,19 +911,12 @@ def node_exists(api, node_name):
 
 def append_node_labels(api, node_name, node_role, instance_lifecycle):
 
-    node_role_label = "node-role.kubernetes.io/%s" % (node_role)
-
-    patch_body = {
-        "metadata": {
-            "labels": {
-                "lifecycle": instance_lifecycle,
-                node_role_label: ""
-            }
-        }
-    }
+    mutation = NodeMutation(node_name)
+    for key, value in node_labels(node_role, instance_lifecycle).items():
+        mutation.label(key, value)
 
     try:
-        api.patch_node(node_name, patch_body)
+        mutation.apply(api)
         logger.info(
             'Node {} has been labeled with role={}'.format(node_name, node_role))
     except:
@@ -320,35 +928,19 @@ def abandon_lifecycle_action(asg_client, auto_scaling_group_name, lifecycle_hook
     """Completes the lifecycle action with the ABANDON result, which stops any remaining actions,
     such as other lifecycle hooks.
     """
-    asg_client.complete_lifecycle_action(LifecycleHookName=lifecycle_hook_name,
-                                         AutoScalingGroupName=auto_scaling_group_name,
-                                         LifecycleActionResult='ABANDON',
-                                         InstanceId=instance_id)
+    with metrics.timer('CompleteLifecycleActionTime'):
+        asg_client.complete_lifecycle_action(LifecycleHookName=lifecycle_hook_name,
+                                             AutoScalingGroupName=auto_scaling_group_name,
+                                             LifecycleActionResult='ABANDON',
+                                             InstanceId=instance_id)
 
 
 def continue_lifecycle_action(asg_client, auto_scaling_group_name, lifecycle_hook_name, instance_id):
     """Completes the lifecycle action with the CONTINUE result, which continues the  remaining actions,
     such as other lifecycle hooks.
     """
-    asg_client.complete_lifecycle_action(LifecycleHookName=lifecycle_hook_name,
-                                         AutoScalingGroupName=auto_scaling_group_name,
-                                         LifecycleActionResult='CONTINUE',
-                                         InstanceId=instance_id)
-
-
-def exclude_node_from_loadbalancer(api, node_name):
-    """Excludes the node from external load balancers, such as AWS load balancer target groups.
-    """
-    patch_body = {
-        "metadata": {
-            "labels": {
-                "node.kubernetes.io/exclude-from-external-load-balancers": "asg-lifecycle-hook"
-            }
-        }
-    }
-
-    try:
-        api.patch_node(node_name, patch_body)
-    except:
-        logger.exception(
-            'There was an error appending exclude from loadbalancer label to the node {} '.format(node_name))
+    with metrics.timer('CompleteLifecycleActionTime'):
+        asg_client.complete_lifecycle_action(LifecycleHookName=lifecycle_hook_name,
+                                             AutoScalingGroupName=auto_scaling_group_name,
+                                             LifecycleActionResult='CONTINUE',
+                                             InstanceId=instance_id)
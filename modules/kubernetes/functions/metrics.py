@@ -0,0 +1,110 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'ASGLifecycleHook')
+
+# The metrics of the lifecycle hook being processed by the current thread, if any
+current = contextvars.ContextVar('metrics', default=None)
+
+
+class Metrics(object):
+    """Collects the timings and counters of one lifecycle hook and emits them as a CloudWatch
+    Embedded Metric Format log line, which CloudWatch turns into metrics without any API call.
+    """
+
+    def __init__(self, dimensions, **properties):
+        self.dimensions = dimensions
+        self.properties = properties
+        self.values = {}
+        self.units = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, value, unit='Count'):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def emit(self):
+        with self.lock:
+            if not self.values:
+                return
+            document = dict((key, str(value)) for key, value in self.properties.items())
+            document.update(self.values)
+            document['_aws'] = {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [self.dimensions],
+                    'Metrics': [{'Name': name, 'Unit': self.units[name]} for name in sorted(self.values)]
+                }]
+            }
+        # Lambda ships stdout to CloudWatch Logs, which extracts the metrics
+        print(json.dumps(document))
+
+
+def count(name, value=1, unit='Count'):
+    metrics = current.get()
+    if metrics is not None:
+        metrics.add(name, value, unit)
+
+
+@contextmanager
+def timer(name):
+    """Adds the time spent in the block to the named metric in milliseconds."""
+    started = time.time()
+    try:
+        yield
+    finally:
+        metrics = current.get()
+        if metrics is not None:
+            metrics.add(name, (time.time() - started) * 1000, 'Milliseconds')
+
+
+@contextmanager
+def scope(metrics):
+    """Makes metrics the current metrics of the block and emits them when the block ends."""
+    token = current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        current.reset(token)
+        try:
+            metrics.emit()
+        except:
+            logger.exception('There was an error emitting metrics')
+
+
+def hook_metrics(asg_name, transition, instance_id):
+    return Metrics(['AutoScalingGroupName', 'LifecycleTransition'], AutoScalingGroupName=asg_name,
+                   LifecycleTransition=transition, InstanceId=instance_id)
+
+
+def instrument_boto3_client(client):
+    """Counts the calls of the boto3 client, including its retries."""
+    client.meta.events.register('before-send', lambda **kwargs: count('AwsCalls'))
+    return client
+
+
+def instrument_api_client(api_client):
+    """Counts the requests of the Kubernetes API client and the bytes of the preloaded responses."""
+    rest_client = api_client.rest_client
+    request = rest_client.request
+
+    def counted_request(*args, **kwargs):
+        count('KubernetesCalls')
+        response = request(*args, **kwargs)
+        if kwargs.get('_preload_content', True) and getattr(response, 'data', None) is not None:
+            count('KubernetesBytesReceived', len(response.data), 'Bytes')
+        return response
+
+    rest_client.request = counted_request
+    return api_client
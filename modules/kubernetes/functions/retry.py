@@ -0,0 +1,108 @@
+import contextvars
+import logging
+import random
+import time
+
+from contextlib import contextmanager
+
+from urllib3.exceptions import HTTPError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SAFETY_MARGIN = 10  # Seconds kept to complete the lifecycle action before the invocation times out
+RETRYABLE_STATUSES = (408, 429, 500, 502, 503, 504)
+RETRYABLE_AWS_ERRORS = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                        'RequestTimeout', 'ServiceUnavailable', 'InternalError', 'InternalFailure')
+
+# The time by which the lifecycle hook being processed by the current thread must be done, if any
+current = contextvars.ContextVar('deadline', default=None)
+
+
+def deadline(seconds):
+    """Returns the time the given seconds from now, but no later than the current deadline."""
+    at = time.time() + seconds
+    bound = current.get()
+    return at if bound is None else min(at, bound)
+
+
+def remaining():
+    """Returns the seconds left until the current deadline, or None without one."""
+    bound = current.get()
+    return None if bound is None else max(0, bound - time.time())
+
+
+def invocation_deadline(context):
+    """Returns the time by which the work of the Lambda invocation must be done, or None when
+    there is no Lambda context, e.g. in tests and benchmarks.
+    """
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.time() + context.get_remaining_time_in_millis() / 1000.0 - SAFETY_MARGIN
+
+
+@contextmanager
+def scope(at):
+    """Makes at the current deadline of the block, unless an enclosing deadline is earlier."""
+    bound = current.get()
+    if at is None or (bound is not None and bound < at):
+        at = bound
+    token = current.set(at)
+    try:
+        yield at
+    finally:
+        current.reset(token)
+
+
+def backoff(attempt, base=1, cap=10):
+    """Returns the delay before the retry after the given number of attempts, exponential with
+    full jitter so that concurrent hooks don't retry in lockstep.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def sleep(seconds, until):
+    """Sleeps for the given seconds but not past until, and returns False once until has passed."""
+    delay = min(seconds, until - time.time())
+    if delay > 0:
+        time.sleep(delay)
+    return time.time() < until
+
+
+def is_retryable(error):
+    """Classifies an error of the Kubernetes or AWS clients as transient, where the same request
+    may succeed later, or as fatal.
+    """
+    # kubernetes.client.rest.ApiException
+    status = getattr(error, 'status', None)
+    if isinstance(status, int) and status > 0:
+        return status in RETRYABLE_STATUSES
+
+    # botocore.exceptions.ClientError
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and 'Error' in response:
+        return (response['Error'].get('Code') in RETRYABLE_AWS_ERRORS
+                or response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+
+    # Connection errors and timeouts of the Kubernetes client
+    return isinstance(error, (HTTPError, ConnectionError, TimeoutError))
+
+
+def call(func, until, base=0.5, cap=10, retryable=is_retryable):
+    """Calls func until it succeeds. Fatal errors are raised at once, retryable ones once there is
+    no time left to retry before until.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            delay = backoff(attempt, base, cap)
+            if not retryable(e) or time.time() + delay >= until:
+                raise
+            logger.warning('Retrying in {:.1f}s after a transient error: {}'.format(delay, e))
+            metrics.count('Retries')
+            time.sleep(delay)
+            attempt += 1
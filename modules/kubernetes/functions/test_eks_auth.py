@@ -0,0 +1,44 @@
+import unittest
+
+from eks_auth import exec_cluster_name
+
+
+def aws_user(*args, **plugin):
+    plugin.update(command='aws', args=['--region', 'us-east-1', 'eks', 'get-token', '--cluster-name', 'c1'] + list(args))
+    return {'exec': plugin}
+
+
+def authenticator_user(*args):
+    return {'exec': {'command': '/usr/local/bin/aws-iam-authenticator', 'args': ['token', '-i', 'c1'] + list(args)}}
+
+
+class ExecClusterNameTest(unittest.TestCase):
+
+    def test_lambda_identity(self):
+        self.assertEqual(exec_cluster_name(aws_user()), 'c1')
+        self.assertEqual(exec_cluster_name(authenticator_user()), 'c1')
+        self.assertEqual(exec_cluster_name(aws_user(env=[])), 'c1')
+
+    def test_other_identity(self):
+        for args in (['--role-arn', 'arn:aws:iam::111122223333:role/admin'],
+                     ['--role-arn=arn:aws:iam::111122223333:role/admin'],
+                     ['--profile', 'admin'],
+                     ['--profile=admin']):
+            self.assertIsNone(exec_cluster_name(aws_user(*args)), args)
+        for args in (['-r', 'arn:aws:iam::111122223333:role/admin'],
+                     ['--role', 'arn:aws:iam::111122223333:role/admin'],
+                     ['--role=arn:aws:iam::111122223333:role/admin']):
+            self.assertIsNone(exec_cluster_name(authenticator_user(*args)), args)
+
+    def test_environment(self):
+        for name in ('AWS_PROFILE', 'AWS_ROLE_ARN'):
+            self.assertIsNone(exec_cluster_name(aws_user(env=[{'name': name, 'value': 'admin'}])), name)
+
+    def test_other_plugins(self):
+        self.assertIsNone(exec_cluster_name(None))
+        self.assertIsNone(exec_cluster_name({'token': 'secret'}))
+        self.assertIsNone(exec_cluster_name({'exec': {'command': 'gke-gcloud-auth-plugin', 'args': []}}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,17 @@
 locals {
   lambda_environment_variables = {
-    CLUSTER_NAME         = var.cluster_name
-    KUBE_CONFIG_BUCKET   = var.kubeconfig_s3_bucket
-    KUBE_CONFIG_OBJECT   = var.kubeconfig_s3_object
-    KUBERNETES_NODE_ROLE = var.kubernetes_node_role
-    LAUNCHING_TIMEOUT    = var.heartbeat_timeout["launching"]
-    TERMINATING_TIMEOUT  = var.heartbeat_timeout["terminating"]
+    CLUSTER_NAME          = var.cluster_name
+    KUBE_CONFIG_BUCKET    = var.kubeconfig_s3_bucket
+    KUBE_CONFIG_OBJECT    = var.kubeconfig_s3_object
+    KUBERNETES_NODE_ROLE  = var.kubernetes_node_role
+    LAUNCHING_TIMEOUT     = var.heartbeat_timeout["launching"]
+    TERMINATING_TIMEOUT   = var.heartbeat_timeout["terminating"]
+    EVICTION_CONCURRENCY  = var.eviction_concurrency
+    METRICS_NAMESPACE     = var.metrics_namespace
+    CONTINUATION_INTERVAL = var.continuation_interval
+    DRAIN_ORDER           = var.drain_policy.order
+    JOB_GRACE_PERIOD      = var.drain_policy.job_grace_period != null ? var.drain_policy.job_grace_period : ""
+    DRAIN_WAIT_FOR_JOBS   = var.drain_policy.wait_for_jobs
   }
 }
 
@@ -20,6 +26,9 @@ module "k8s_lifecycle_hooks" {
   lambda_runtime                         = var.lambda_runtime
   lambda_source_path                     = "${path.module}/functions"
   lambda_environment_variables           = local.lambda_environment_variables
+  enable_continuation                    = var.enable_continuation
+  enable_deduplication                   = var.enable_deduplication
+  enable_spot_drain                      = var.enable_spot_drain
   lambda_function_vpc_subnet_ids         = var.lambda_function_vpc_subnet_ids
   lambda_function_vpc_security_group_ids = [aws_security_group.k8s_lifecycle.id]
   extra_tags                             = var.extra_tags
@@ -58,6 +67,7 @@ data "aws_iam_policy_document" "k8s_lifecycle" {
       "autoscaling:DescribeAutoScalingGroups",
       "autoscaling:DescribeLoadBalancers",
       "autoscaling:CompleteLifecycleAction",
+      "autoscaling:RecordLifecycleActionHeartbeat",
       "ec2:DescribeInstances",
       "ec2:CreateTags"
     ]
@@ -69,7 +79,8 @@ data "aws_iam_policy_document" "k8s_lifecycle" {
     sid = "ELB"
     actions = [
       "elasticloadbalancing:DescribeLoadBalancers",
-      "elasticloadbalancing:DescribeInstanceHealth"
+      "elasticloadbalancing:DescribeInstanceHealth",
+      "elasticloadbalancing:DescribeTargetHealth"
     ]
     resources = [
       "*"
@@ -84,6 +95,34 @@ data "aws_iam_policy_document" "k8s_lifecycle" {
       "arn:aws:s3:::${var.kubeconfig_s3_bucket}/*"
     ]
   }
+  dynamic "statement" {
+    for_each = var.enable_continuation ? [module.k8s_lifecycle_hooks.continuation_role_arn] : []
+    content {
+      sid = "Continuation"
+      actions = [
+        "scheduler:CreateSchedule",
+        "iam:PassRole"
+      ]
+      resources = [
+        "arn:aws:scheduler:*:*:schedule/default/*",
+        statement.value
+      ]
+    }
+  }
+  dynamic "statement" {
+    for_each = var.enable_deduplication || var.enable_spot_drain ? [module.k8s_lifecycle_hooks.deduplication_table_arn] : []
+    content {
+      sid = "Deduplication"
+      actions = [
+        "dynamodb:GetItem",
+        "dynamodb:PutItem",
+        "dynamodb:DeleteItem"
+      ]
+      resources = [
+        statement.value
+      ]
+    }
+  }
 }
 
 resource "aws_iam_policy" "k8s_lifecycle" {
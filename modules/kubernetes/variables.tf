@@ -8,6 +8,12 @@ variable "cluster_name" {
   type        = string
 }
 
+variable "continuation_interval" {
+  description = "The seconds between the invocations continuing a lifecycle action when continuation is enabled"
+  type        = number
+  default     = 60
+}
+
 variable "default_result" {
   description = "(optional) describe your variable"
   type = object({
@@ -20,6 +26,45 @@ variable "default_result" {
   }
 }
 
+variable "drain_policy" {
+  description = "How nodes are drained. The \"workload\" order evicts the pods of stateless workloads first, then the pods of StatefulSets one at a time, then the pods of Jobs with job_grace_period seconds to terminate. Without wait_for_jobs the lifecycle action completes once every pod but those of Jobs is gone"
+  type = object({
+    order            = optional(string, "default")
+    job_grace_period = optional(number)
+    wait_for_jobs    = optional(bool, true)
+  })
+  default = {}
+
+  validation {
+    condition     = contains(["default", "workload"], var.drain_policy.order)
+    error_message = "The drain order must be \"default\" or \"workload\"."
+  }
+}
+
+variable "enable_continuation" {
+  description = "Whether a drain or a launch is continued by later invocations instead of keeping one Lambda waiting"
+  type        = bool
+  default     = false
+}
+
+variable "enable_deduplication" {
+  description = "Whether processed lifecycle messages are recorded in a DynamoDB table, so that duplicate deliveries are skipped across Lambda containers"
+  type        = bool
+  default     = false
+}
+
+variable "enable_spot_drain" {
+  description = "Whether nodes of spot instances are drained on their interruption warnings and rebalance recommendations, which suits groups with capacity rebalancing. Implies enable_deduplication"
+  type        = bool
+  default     = false
+}
+
+variable "eviction_concurrency" {
+  description = "The maximum number of pod evictions or deletions in flight while draining a node"
+  type        = number
+  default     = 10
+}
+
 variable "extra_tags" {
   description = "The extra tag for resource"
   type        = map(string)
@@ -71,6 +116,12 @@ variable "lambda_runtime" {
   default     = "python3.13"
 }
 
+variable "metrics_namespace" {
+  description = "The CloudWatch namespace of the metrics the lifecycle hook emits in embedded metric format logs"
+  type        = string
+  default     = "ASGLifecycleHook"
+}
+
 variable "name" {
   description = "The resource identify name"
   type        = string
@@ -1,3 +1,15 @@
 output "lambda_role_name" {
   value = module.lambda.lambda_role_name
-}
\ No newline at end of file
+}
+
+output "sns_topic_arn" {
+  value = aws_sns_topic.lifecycle.arn
+}
+
+output "continuation_role_arn" {
+  value = one(aws_iam_role.continuation[*].arn)
+}
+
+output "deduplication_table_arn" {
+  value = one(aws_dynamodb_table.deduplication[*].arn)
+}
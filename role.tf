@@ -27,4 +27,44 @@ resource "aws_iam_role_policy" "lifecycle" {
   name   = "${var.name}-asg"
   role   = aws_iam_role.lifecycle.id
   policy = data.aws_iam_policy_document.lifecycle.json
-}
\ No newline at end of file
+}
+
+# Lets EventBridge Scheduler re-publish a lifecycle hook to the topic when the Lambda continues it later
+data "aws_iam_policy_document" "continuation_profile" {
+  count = var.enable_continuation ? 1 : 0
+
+  statement {
+    effect  = "Allow"
+    actions = ["sts:AssumeRole"]
+
+    principals {
+      type        = "Service"
+      identifiers = ["scheduler.amazonaws.com"]
+    }
+  }
+}
+
+resource "aws_iam_role" "continuation" {
+  count = var.enable_continuation ? 1 : 0
+
+  name               = "${var.name}-continuation"
+  assume_role_policy = data.aws_iam_policy_document.continuation_profile[0].json
+}
+
+data "aws_iam_policy_document" "continuation" {
+  count = var.enable_continuation ? 1 : 0
+
+  statement {
+    effect    = "Allow"
+    actions   = ["sns:Publish"]
+    resources = [aws_sns_topic.lifecycle.arn]
+  }
+}
+
+resource "aws_iam_role_policy" "continuation" {
+  count = var.enable_continuation ? 1 : 0
+
+  name   = "${var.name}-continuation"
+  role   = aws_iam_role.continuation[0].id
+  policy = data.aws_iam_policy_document.continuation[0].json
+}
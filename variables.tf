@@ -88,6 +88,24 @@ variable "lambda_environment_variables" {
   default     = {}
 }
 
+variable "enable_continuation" {
+  description = "Whether the Lambda schedules the rest of a long lifecycle action as a later invocation instead of waiting for it"
+  type        = bool
+  default     = false
+}
+
+variable "enable_deduplication" {
+  description = "Whether the Lambda records processed lifecycle messages in a DynamoDB table, so that duplicate deliveries are skipped across containers"
+  type        = bool
+  default     = false
+}
+
+variable "enable_spot_drain" {
+  description = "Whether spot interruption warnings and rebalance recommendations of the group's instances drain their nodes ahead of the terminating lifecycle hook. Implies enable_deduplication"
+  type        = bool
+  default     = false
+}
+
 variable "iam_role_boundary_policy_arn" {
   description = "The ARN of the policy that is used to set the permissions boundary for the role"
   type        = string